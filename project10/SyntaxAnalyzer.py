@@ -5,9 +5,11 @@ Created on Sun Oct 29 18:53:46 2017
 @author: zheng
 """
 
+import array
 import sys
 import enum
 import os
+import re
 
 class TokenType(enum.Enum):
     KEYWORD = 1
@@ -27,6 +29,102 @@ SPEICAL_XML_CHAR = {'<': '&lt;',
                     '"': '&quot;',
                     '&': '&amp;'}
 
+
+# Skips spaces and comments, then matches one token. Comments may start
+# and end anywhere; an unclosed comment or string, or any other character,
+# is an error. Only spaces and comments are left when no group matches.
+TOKEN_PATTERN = re.compile(r'''
+    (?:\s+|//[^\n]*|/\*.*?\*/)*
+    (?:(?P<integer>[0-9]+)
+     | "(?P<string>[^"\n]*)"
+     | (?P<unclosed>/\*|")
+     | (?P<symbol>[{}()\[\].,;+\-*/&|<>=~])
+     | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+     | (?P<error>.)
+     | $)
+''', re.DOTALL | re.VERBOSE)
+
+KEYWORD_LIST = ['class', 'constructor', 'function', 'method', 'field',
+                'static', 'var', 'int', 'char', 'boolean', 'void', 'true',
+                'false', 'null', 'this', 'let', 'do', 'if', 'else', 'while',
+                'return']
+
+SYMBOL_LIST = ['{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*',
+               '/', '&', '|', '<', '>', '=', '~']
+
+# Every string table starts with the keywords and symbols, so their ids are
+# the same in every file and the parser can compare ids instead of strings.
+TOKEN_IDS = dict((token, index) for index, token
+                 in enumerate(KEYWORD_LIST + SYMBOL_LIST))
+
+KEYWORDS = frozenset(KEYWORD_LIST)
+
+TOKEN_TYPES = dict((token_type.value, token_type) for token_type in TokenType)
+
+# type codes in TokenStream.types
+(KEYWORD_TYPE, SYMBOL_TYPE, INTEGER_TYPE, STRING_TYPE,
+ IDENTIFIER_TYPE) = [token_type.value for token_type in TokenType]
+
+# ids of the keywords and symbols the parser checks
+(CLASS_ID, STATIC_ID, FIELD_ID, CONSTRUCTOR_ID, FUNCTION_ID, METHOD_ID, VAR_ID,
+ LET_ID, DO_ID, IF_ID, ELSE_ID, WHILE_ID, RETURN_ID) = [
+    TOKEN_IDS[token] for token in ['class', 'static', 'field', 'constructor',
+                                   'function', 'method', 'var', 'let', 'do',
+                                   'if', 'else', 'while', 'return']]
+OPEN_PAREN_ID, OPEN_BRACKET_ID, DOT_ID, COMMA_ID = [TOKEN_IDS[token]
+                                                    for token in '([.,']
+
+GROUP_TYPES = {'integer': INTEGER_TYPE,
+               'string': STRING_TYPE,
+               'symbol': SYMBOL_TYPE,
+               'word': IDENTIFIER_TYPE}
+
+
+def LineColumn(text, offset):
+    # both from 1
+    return (text.count('\n', 0, offset) + 1,
+            offset - text.rfind('\n', 0, offset))
+
+
+class TokenStream(object):
+    # Parallel arrays, one entry per token: the TokenType value, the index of
+    # the token in the string table and its offset in text.
+    __slots__ = ('text', 'types', 'ids', 'offsets', 'strings')
+
+    def __init__(self, text):
+        self.text = text
+        self.types = array.array('B')
+        self.ids = array.array('I')
+        self.offsets = array.array('I')
+        self.strings = []
+
+
+def Tokenize(text, filename='<input>'):
+    # scans the whole text in one pass
+    stream = TokenStream(text)
+    types = stream.types
+    ids = stream.ids
+    offsets = stream.offsets
+    table = dict(TOKEN_IDS)
+    for match in TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == None:
+            break
+        token = match.group(kind)
+        token_type = GROUP_TYPES.get(kind)
+        if token_type == None:
+            raise ValueError('%s:%d:%d: unexpected %r'
+                             %((filename,) + LineColumn(text, match.start(kind))
+                               + (token,)))
+        if token_type == IDENTIFIER_TYPE and token in KEYWORDS:
+            token_type = KEYWORD_TYPE
+        types.append(token_type)
+        # new tokens are numbered in order of first appearance
+        ids.append(table.setdefault(token, len(table)))
+        offsets.append(match.start(kind))
+    stream.strings = list(table)
+    return stream
+
                     
 def xmlLabel(value, is_end=False, indent=0):
     if is_end:
@@ -37,121 +135,85 @@ def xmlLabel(value, is_end=False, indent=0):
 
     
 class Tokenizer(object):
-    
-    KEYWORD_LIST = ['class', 'constructor', 'function', 'method', 'field', 
-                    'static', 'var', 'int', 'char', 'boolean', 'void', 'true',
-                    'false', 'null', 'this', 'let', 'do', 'if', 'else',
-                    'while', 'return']
-    
-    SYMBOL_LIST = ['{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*',
-                   '/', '&', '|', '<', '>', '=', '~']
+    # A cursor over a TokenStream
+    __slots__ = ('stream', 'index', 'current_type', 'current_id', 'output')
     
     def __init__(self, input_filename, output_filename=None):
-        self.input = open(input_filename, 'r')
-        self.current_words = []
-        self.current_token = None
+        with open(input_filename, 'r') as f:
+            self.stream = Tokenize(f.read(), input_filename)
+        self.index = -1
         self.current_type = None
-        self.current_line = None
+        self.current_id = None
         self.output = None       
         if output_filename:
             self.output = open(output_filename, 'w')
             self.output.write(xmlLabel('tokens'))
             self.output.write('\n')
-        self.readline()
-        self.advance()
+            if not self.stream.types:
+                self.closeOutput()
+        if self.stream.types:
+            self.advance()
         
     def hasMoreTokens(self):
-        return bool(self.current_line)
-    
-    def readinputline(self):
-        line = self.input.readline()
-        if not line:
-            self.input.close()
-            if self.output: 
-                self.output.write(xmlLabel('tokens', True))
-                self.output.close()          
-        return line
+        return self.index + 1 < len(self.stream.types)
     
-    def readline(self):
-        self.current_line = self.readinputline()
-        while self.current_line:
-            self.current_line = self.current_line.strip()
-            # comment in /** */
-            # assumes /** always at the beginning of a line
-            # and */ always at the end of a line
-            if self.current_line.startswith('/**'):
-                while not self.current_line.endswith('*/'):
-                    self.current_line = self.readinputline().strip()
-                self.current_line = self.readinputline()
-                # continue to check /** */ patten
-                continue
-            # comment start with //
-            self.current_line = self.current_line.split('//')[0].strip()
-            if not self.current_line:  # empty line
-                self.current_line = self.readinputline()
-            else:  # non-empty line
-                break
+    def closeOutput(self):
+        self.output.write(xmlLabel('tokens', True))
+        self.output.close()
     
     def advance(self):        
-        def isValidChar(c):
-            return ('0' <= c <= '9' or 'a' <= c <= 'z' or 'A' <= c <= 'Z' or 
-                    c == '_')
-                    
-        line = self.current_line  # alias copy
-        token_len = 1
-        if '0' <= line[0] <= '9':  # integer constant            
-            while token_len < len(line) and '0' <= line[token_len] <= '9':
-                token_len += 1
-            self.current_type = TokenType.INTEGER
-            self.current_token = line[:token_len]
-        elif line[0] == '"':  # string constant
-            while token_len < len(line) and line[token_len] != '"':
-                token_len += 1
-            self.current_type = TokenType.STRING
-            self.current_token = line[1:token_len]
-            token_len += 1
-        elif line[0] in self.SYMBOL_LIST:
-            self.current_type = TokenType.SYMBOL
-            self.current_token = line[0]
-        else:  # identifier or keywords
-            while token_len < len(line) and isValidChar(line[token_len]):
-                token_len += 1
-            self.current_token = line[:token_len]
-            if self.current_token in self.KEYWORD_LIST:
-                self.current_type = TokenType.KEYWORD
-            else: 
-                self.current_type = TokenType.IDENTIFIER   
+        self.index += 1
+        self.current_type = self.stream.types[self.index]
+        self.current_id = self.stream.ids[self.index]
         
         if self.output:
             label = self.tokenTypeStr()
+            token = self.currentToken()
             self.output.write(xmlLabel(label)+' ')
-            if self.current_token in SPEICAL_XML_CHAR:
-                self.output.write(SPEICAL_XML_CHAR[self.current_token])
+            if token in SPEICAL_XML_CHAR:
+                self.output.write(SPEICAL_XML_CHAR[token])
             else:
-                self.output.write(self.current_token)
+                self.output.write(token)
             self.output.write(' '+xmlLabel(label,True))
             self.output.write('\n')
-        
-        self.current_line = line[token_len:].lstrip()
-        if not self.current_line:
-            self.readline()            
+            if not self.hasMoreTokens():
+                self.closeOutput()
         
     def currentToken(self):
-        return self.current_token
+        if self.current_id == None:
+            return None
+        return self.stream.strings[self.current_id]
     
     def tokenType(self):
-        return self.current_type
+        return TOKEN_TYPES.get(self.current_type)
     
     def tokenTypeStr(self):
-        return TOKENTYPE_FORMAT[self.current_type]
+        return TOKENTYPE_FORMAT[self.tokenType()]
+    
+    def peek(self, offset=1):
+        # id of the token offset tokens ahead of the current one, or None
+        # past the end
+        index = self.index + offset
+        if index < len(self.stream.ids):
+            return self.stream.ids[index]
+        return None
+    
+    def currentPosition(self):
+        # (line, column) of the current token
+        return LineColumn(self.stream.text, self.stream.offsets[self.index])
 
 class CompilationEngine(object):
     
-    KEYWORD_CONSTANTS = ['true', 'false', 'null', 'this']
+    KEYWORD_CONSTANTS = frozenset(TOKEN_IDS[token] for token
+                                  in ['true', 'false', 'null', 'this'])
+    
+    OP = frozenset(TOKEN_IDS[token] for token in '+-*/&|<>=')
+    
+    UNARY_OP = frozenset(TOKEN_IDS[token] for token in '-~')
     
-    OP = ['+', '-', '*', '/', '&', '|', '<', '>', '=']
+    TERM_TYPES = frozenset([INTEGER_TYPE, STRING_TYPE, IDENTIFIER_TYPE])
     
-    UNARY_OP = ['-', '~']
+    TERM_IDS = KEYWORD_CONSTANTS | UNARY_OP | frozenset([OPEN_PAREN_ID])
     
     def __init__(self, input_filename, output_filename):
         self.tokenizer = Tokenizer(input_filename)
@@ -184,7 +246,7 @@ class CompilationEngine(object):
         self.writeToken()
         
     def compileClass(self):
-        if self.tokenizer.currentToken() != 'class':
+        if self.tokenizer.current_id != CLASS_ID:
             return False       
         self.writeln('class', is_end=False)
         self.indent += 2
@@ -204,16 +266,16 @@ class CompilationEngine(object):
         return True
         
     def compileClassVarDec(self):
-        if self.tokenizer.currentToken() not in ['static', 'field']:
+        if self.tokenizer.current_id not in [STATIC_ID, FIELD_ID]:
             return False
         self.writeln('classVarDec', is_end=False)
         self.indent += 2
         for _ in range(2):
             self.writeToken()
-        while self.tokenizer.tokenType() == TokenType.IDENTIFIER:
+        while self.tokenizer.current_type == IDENTIFIER_TYPE:
             # varName
             self.writeToken()
-            if self.tokenizer.currentToken() == ',':
+            if self.tokenizer.current_id == COMMA_ID:
                 self.writeToken()
         # ';'
         self.writeToken()
@@ -222,8 +284,8 @@ class CompilationEngine(object):
         return True       
     
     def compileSubroutineDec(self):
-        if self.tokenizer.currentToken() not in ['constructor', 'function',
-                                                 'method']:
+        if self.tokenizer.current_id not in [CONSTRUCTOR_ID, FUNCTION_ID,
+                                           METHOD_ID]:
             return False        
         self.writeln('subroutineDec', is_end=False)
         self.indent += 2
@@ -239,11 +301,10 @@ class CompilationEngine(object):
     def compileParameterList(self):
         self.writeln('parameterList', is_end=False)
         self.indent += 2
-        while (self.tokenizer.tokenType() == TokenType.IDENTIFIER or 
-               self.tokenizer.tokenType() == TokenType.KEYWORD):
+        while self.tokenizer.current_type in [IDENTIFIER_TYPE, KEYWORD_TYPE]:
             for _ in range(2):
                 self.writeToken()
-            if self.tokenizer.currentToken() == ',':
+            if self.tokenizer.current_id == COMMA_ID:
                 self.writeToken()
         self.indent -= 2
         self.writeln('parameterList', is_end=True)
@@ -264,17 +325,17 @@ class CompilationEngine(object):
         return True
 
     def compileVarDec(self):
-        if self.tokenizer.currentToken() != 'var':
+        if self.tokenizer.current_id != VAR_ID:
             return False       
         self.writeln('varDec', is_end=False)
         self.indent += 2
         # var, type
         for _ in range(2):
             self.writeToken()
-        while self.tokenizer.tokenType() == TokenType.IDENTIFIER:
+        while self.tokenizer.current_type == IDENTIFIER_TYPE:
             # varName
             self.writeToken()
-            if self.tokenizer.currentToken() == ',':
+            if self.tokenizer.current_id == COMMA_ID:
                 self.writeToken()
         # ';'
         self.writeToken()
@@ -296,14 +357,14 @@ class CompilationEngine(object):
         return True
     
     def compileLet(self):
-        if self.tokenizer.currentToken() != 'let':
+        if self.tokenizer.current_id != LET_ID:
             return False        
         self.writeln('letStatement', is_end=False)
         self.indent += 2
         # let, var
         for _ in range(2):
             self.writeToken()
-        if self.tokenizer.currentToken() == '[':
+        if self.tokenizer.current_id == OPEN_BRACKET_ID:
             self.writeBracketSyntax(self.compileExpression)           
         # '='
         self.writeToken()
@@ -315,7 +376,7 @@ class CompilationEngine(object):
         return True
     
     def compileWhile(self):
-        if self.tokenizer.currentToken() != 'while':
+        if self.tokenizer.current_id != WHILE_ID:
             return False
         self.writeln('whileStatement', is_end=False)
         self.indent += 2
@@ -328,7 +389,7 @@ class CompilationEngine(object):
         return True
         
     def compileIf(self):
-        if self.tokenizer.currentToken() != 'if':
+        if self.tokenizer.current_id != IF_ID:
             return False
         self.writeln('ifStatement', is_end=False)
         self.indent += 2
@@ -336,7 +397,7 @@ class CompilationEngine(object):
         self.writeToken()
         self.writeBracketSyntax(self.compileExpression)
         self.writeBracketSyntax(self.compileStatements)
-        if self.tokenizer.currentToken() == 'else':
+        if self.tokenizer.current_id == ELSE_ID:
             # else
             self.writeToken()
             self.writeBracketSyntax(self.compileStatements)
@@ -345,16 +406,16 @@ class CompilationEngine(object):
         return True
 
     def compileDo(self):
-        if self.tokenizer.currentToken() != 'do':
+        if self.tokenizer.current_id != DO_ID:
             return False
         self.writeln('doStatement', is_end=False)
         self.indent += 2
         # do, subroutine name | className | varName
         for _ in range(2):
             self.writeToken()
-        if self.tokenizer.currentToken() == '(':
+        if self.tokenizer.current_id == OPEN_PAREN_ID:
             self.writeBracketSyntax(self.compileExpressionList)
-        elif self.tokenizer.currentToken() == '.':
+        elif self.tokenizer.current_id == DOT_ID:
             # '.', subroutineName
             for _ in range(2):
                 self.writeToken()
@@ -366,7 +427,7 @@ class CompilationEngine(object):
         return True
     
     def compileReturn(self):
-        if self.tokenizer.currentToken() != 'return':
+        if self.tokenizer.current_id != RETURN_ID:
             return False
         self.writeln('returnStatement', is_end=False)
         self.indent += 2
@@ -383,7 +444,7 @@ class CompilationEngine(object):
         self.writeln('expressionList', is_end=False)
         self.indent += 2
         if self.compileExpression():
-            while self.tokenizer.currentToken() == ',':
+            while self.tokenizer.current_id == COMMA_ID:
                 # ','
                 self.writeToken()
                 self.compileExpression()
@@ -392,12 +453,8 @@ class CompilationEngine(object):
         return True
     
     def isTerm(self):
-        return (self.tokenizer.tokenType() == TokenType.INTEGER or
-                self.tokenizer.tokenType() == TokenType.STRING or
-                self.tokenizer.tokenType() == TokenType.IDENTIFIER or
-                self.tokenizer.currentToken() in self.KEYWORD_CONSTANTS or
-                self.tokenizer.currentToken() == '(' or
-                self.tokenizer.currentToken() in self.UNARY_OP)
+        return (self.tokenizer.current_type in self.TERM_TYPES or
+                self.tokenizer.current_id in self.TERM_IDS)
     
     def compileExpression(self):
         if not self.isTerm():
@@ -405,7 +462,7 @@ class CompilationEngine(object):
         self.writeln('expression', is_end=False)
         self.indent += 2
         self.compileTerm()
-        while self.tokenizer.currentToken() in self.OP:
+        while self.tokenizer.current_id in self.OP:
             self.writeToken()
             self.compileTerm()
         self.indent -= 2
@@ -417,24 +474,24 @@ class CompilationEngine(object):
             return False
         self.writeln('term', is_end=False)
         self.indent += 2
-        if (self.tokenizer.tokenType() == TokenType.INTEGER or
-            self.tokenizer.tokenType() == TokenType.STRING or
-            self.tokenizer.currentToken() in self.KEYWORD_CONSTANTS):
+        if (self.tokenizer.current_type in [INTEGER_TYPE, STRING_TYPE] or
+            self.tokenizer.current_id in self.KEYWORD_CONSTANTS):
             self.writeToken()
-        elif self.tokenizer.tokenType() == TokenType.IDENTIFIER:
+        elif self.tokenizer.current_type == IDENTIFIER_TYPE:
+            next_id = self.tokenizer.peek()
             self.writeToken()
-            if self.tokenizer.currentToken() == '[':
+            if next_id == OPEN_BRACKET_ID:
                 self.writeBracketSyntax(self.compileExpression)
-            elif self.tokenizer.currentToken() == '(':
+            elif next_id == OPEN_PAREN_ID:
                 self.writeBracketSyntax(self.compileExpressionList)
-            elif self.tokenizer.currentToken() == '.':
+            elif next_id == DOT_ID:
                 # '.', subroutineName
                 for _ in range(2):
                     self.writeToken()
                 self.writeBracketSyntax(self.compileExpressionList)
-        elif self.tokenizer.currentToken() == '(':
+        elif self.tokenizer.current_id == OPEN_PAREN_ID:
             self.writeBracketSyntax(self.compileExpression)                             
-        elif self.tokenizer.currentToken() in self.UNARY_OP:
+        elif self.tokenizer.current_id in self.UNARY_OP:
             self.writeToken()
             self.compileTerm()
         self.indent -= 2
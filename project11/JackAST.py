@@ -0,0 +1,682 @@
+# -*- coding: utf-8 -*-
+"""
+Compiles Jack classes through an AST instead of emitting VM code while
+parsing. Each class is parsed into slotted node classes, rewritten by the
+passes in PASSES and then written out by VMEmitter, the final pass. With no
+passes the output is the same as JackCompiler.CompilationEngine, which
+stays the fast path.
+"""
+
+import os
+import sys
+
+from JackCompiler import (
+    CLASS_ID, COMMA_ID, CONSTRUCTOR_ID, DO_ID, DOT_ID, ELSE_ID, FIELD_ID,
+    FUNCTION_ID, IDENTIFIER_TYPE, IF_ID, INTEGER_TYPE, KEYWORD_CONSTANT_IDS,
+    KEYWORD_CONSTANTS_TABLE, KEYWORD_TYPE, LET_ID, METHOD_ID, OP_IDS,
+    OP_TABLE, OPEN_BRACKET_ID, OPEN_PAREN_ID, RETURN_ID, STATIC_ID,
+    STRING_TYPE, TERM_IDS, TERM_TYPES, UNARY_OP_TABLE, VAR_ID, WHILE_ID,
+    ListJackFile, SymbolTable, Tokenizer, VarKind, VMWriter)
+
+
+class Node(object):
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '%s(%s)'%(type(self).__name__,
+                         ', '.join([repr(getattr(self, name))
+                                    for name in self.__slots__]))
+
+
+class Class(Node):
+    __slots__ = ('name', 'var_decs', 'subroutines')
+
+
+class VarDec(Node):
+    __slots__ = ('kind', 'type', 'names')  # kind is a VarKind
+
+
+class Subroutine(Node):
+    # kind is 'constructor', 'function' or 'method'; params are
+    # [(type, name)]
+    __slots__ = ('kind', 'return_type', 'name', 'params', 'var_decs',
+                 'statements')
+
+
+class Let(Node):
+    __slots__ = ('name', 'index', 'value')  # index is None for a variable
+
+
+class If(Node):
+    __slots__ = ('condition', 'statements', 'else_statements')
+
+
+class While(Node):
+    __slots__ = ('condition', 'statements')
+
+
+class Do(Node):
+    __slots__ = ('call',)
+
+
+class Return(Node):
+    __slots__ = ('value',)  # None for 'return;'
+
+
+class IntegerConstant(Node):
+    __slots__ = ('value',)  # may be negative after folding
+
+
+class StringConstant(Node):
+    __slots__ = ('value',)
+
+
+class KeywordConstant(Node):
+    __slots__ = ('keyword',)
+
+
+class VarRef(Node):
+    __slots__ = ('name',)
+
+
+class ArrayRef(Node):
+    __slots__ = ('name', 'index')
+
+
+class Call(Node):
+    # receiver is None for 'f(...)', otherwise a class or variable name
+    __slots__ = ('receiver', 'name', 'args')
+
+
+class Unary(Node):
+    __slots__ = ('op', 'operand')
+
+
+class Binary(Node):
+    __slots__ = ('op', 'left', 'right')
+
+
+class AstBuilder(object):
+    # Parses one class with the same grammar as CompilationEngine
+
+    VARKIND_MAP = {'field': VarKind.FIELD, 'static': VarKind.STATIC,
+                   'var': VarKind.VAR}
+
+    def __init__(self, input_filename):
+        self.tokenizer = Tokenizer(input_filename)
+
+    def advance(self):
+        return self.tokenizer.advance()
+
+    def parseBracketSyntax(self, func):
+        # '(' or '[' or '{', then ')' or ']' or '}'
+        self.advance()
+        res = func()
+        self.advance()
+        return res
+
+    def parseClass(self):
+        if self.tokenizer.current_id != CLASS_ID:
+            return None
+        # class keyword
+        self.advance()
+        # class name, '{'
+        node = Class(self.advance(), [], [])
+        self.advance()
+        while self.tokenizer.current_id in [STATIC_ID, FIELD_ID]:
+            node.var_decs.append(self.parseVarDec())
+        while self.tokenizer.current_id in [CONSTRUCTOR_ID, FUNCTION_ID,
+                                            METHOD_ID]:
+            node.subroutines.append(self.parseSubroutineDec())
+        # '}'
+        if self.tokenizer.hasMoreTokens():
+            raise Exception(('Expect end of tokens, '
+                             'but more tokens are available.'))
+        return node
+
+    def parseVarDec(self):
+        # static, field or var declarations
+        node = VarDec(self.VARKIND_MAP[self.advance()], self.advance(), [])
+        while self.tokenizer.current_type == IDENTIFIER_TYPE:
+            node.names.append(self.advance())
+            if self.tokenizer.current_id == COMMA_ID:
+                self.advance()
+        # ';'
+        self.advance()
+        return node
+
+    def parseSubroutineDec(self):
+        node = Subroutine(self.advance(), self.advance(), self.advance(),
+                          None, [], None)
+        node.params = self.parseBracketSyntax(self.parseParameterList)
+        # '{'
+        self.advance()
+        while self.tokenizer.current_id == VAR_ID:
+            node.var_decs.append(self.parseVarDec())
+        node.statements = self.parseStatements()
+        # '}'
+        self.advance()
+        return node
+
+    def parseParameterList(self):
+        params = []
+        while self.tokenizer.current_type in [IDENTIFIER_TYPE, KEYWORD_TYPE]:
+            params.append((self.advance(), self.advance()))
+            if self.tokenizer.current_id == COMMA_ID:
+                self.advance()
+        return params
+
+    def parseStatements(self):
+        statements = []
+        parsers = {LET_ID: self.parseLet, IF_ID: self.parseIf,
+                   WHILE_ID: self.parseWhile, DO_ID: self.parseDo,
+                   RETURN_ID: self.parseReturn}
+        while self.tokenizer.current_id in parsers:
+            statements.append(parsers[self.tokenizer.current_id]())
+        return statements
+
+    def parseLet(self):
+        # let
+        self.advance()
+        node = Let(self.advance(), None, None)
+        if self.tokenizer.current_id == OPEN_BRACKET_ID:
+            node.index = self.parseBracketSyntax(self.parseExpression)
+        # '='
+        self.advance()
+        node.value = self.parseExpression()
+        # ';'
+        self.advance()
+        return node
+
+    def parseIf(self):
+        # if
+        self.advance()
+        node = If(self.parseBracketSyntax(self.parseExpression),
+                  self.parseBracketSyntax(self.parseStatements), None)
+        if self.tokenizer.current_id == ELSE_ID:
+            # else
+            self.advance()
+            node.else_statements = self.parseBracketSyntax(
+                self.parseStatements)
+        return node
+
+    def parseWhile(self):
+        # while
+        self.advance()
+        return While(self.parseBracketSyntax(self.parseExpression),
+                     self.parseBracketSyntax(self.parseStatements))
+
+    def parseDo(self):
+        # do
+        self.advance()
+        node = Do(self.parseSubroutineCall(self.advance()))
+        # ';'
+        self.advance()
+        return node
+
+    def parseReturn(self):
+        # return
+        self.advance()
+        node = Return(self.parseExpression())
+        # ';'
+        self.advance()
+        return node
+
+    def parseSubroutineCall(self, first_name):
+        receiver = None
+        name = first_name
+        if self.tokenizer.current_id == DOT_ID:
+            # '.'
+            self.advance()
+            receiver = first_name
+            name = self.advance()
+        return Call(receiver, name,
+                    self.parseBracketSyntax(self.parseExpressionList))
+
+    def parseExpressionList(self):
+        args = []
+        expression = self.parseExpression()
+        if expression:
+            args.append(expression)
+            while self.tokenizer.current_id == COMMA_ID:
+                # ','
+                self.advance()
+                args.append(self.parseExpression())
+        return args
+
+    def isTerm(self):
+        return (self.tokenizer.current_type in TERM_TYPES or
+                self.tokenizer.current_id in TERM_IDS)
+
+    def parseExpression(self):
+        # Jack operators have no precedence: terms associate to the left
+        if not self.isTerm():
+            return None
+        node = self.parseTerm()
+        while self.tokenizer.current_id in OP_IDS:
+            node = Binary(self.advance(), node, self.parseTerm())
+        return node
+
+    def parseTerm(self):
+        if self.tokenizer.current_type == INTEGER_TYPE:
+            return IntegerConstant(int(self.advance()))
+        elif self.tokenizer.current_type == STRING_TYPE:
+            return StringConstant(self.advance())
+        elif self.tokenizer.current_id in KEYWORD_CONSTANT_IDS:
+            return KeywordConstant(self.advance())
+        elif self.tokenizer.current_type == IDENTIFIER_TYPE:
+            next_id = self.tokenizer.peek()
+            name = self.advance()
+            if next_id == OPEN_BRACKET_ID:
+                return ArrayRef(name,
+                                self.parseBracketSyntax(self.parseExpression))
+            elif next_id in [DOT_ID, OPEN_PAREN_ID]:
+                return self.parseSubroutineCall(name)
+            return VarRef(name)
+        elif self.tokenizer.current_id == OPEN_PAREN_ID:
+            return self.parseBracketSyntax(self.parseExpression)
+        return Unary(self.advance(), self.parseTerm())
+
+
+def ConstantValue(node):
+    # the signed value of a constant expression node, or None
+    if isinstance(node, IntegerConstant):
+        return node.value
+    if isinstance(node, KeywordConstant) and node.keyword != 'this':
+        return -1 if node.keyword == 'true' else 0
+    return None
+
+
+def IsPure(node):
+    # evaluating the expression has no side effects
+    if isinstance(node, Call):
+        return False
+    if isinstance(node, Binary):
+        return IsPure(node.left) and IsPure(node.right)
+    if isinstance(node, Unary):
+        return IsPure(node.operand)
+    if isinstance(node, ArrayRef):
+        return IsPure(node.index)
+    return True
+
+
+def RewriteExpression(node, rewrite):
+    # rewrites the subexpressions bottom-up, then node itself
+    if isinstance(node, Binary):
+        node.left = RewriteExpression(node.left, rewrite)
+        node.right = RewriteExpression(node.right, rewrite)
+    elif isinstance(node, Unary):
+        node.operand = RewriteExpression(node.operand, rewrite)
+    elif isinstance(node, ArrayRef):
+        node.index = RewriteExpression(node.index, rewrite)
+    elif isinstance(node, Call):
+        node.args = [RewriteExpression(arg, rewrite) for arg in node.args]
+    return rewrite(node)
+
+
+def RewriteStatements(statements, rewrite):
+    for statement in statements:
+        if isinstance(statement, Let):
+            if statement.index != None:
+                statement.index = RewriteExpression(statement.index, rewrite)
+            statement.value = RewriteExpression(statement.value, rewrite)
+        elif isinstance(statement, (If, While)):
+            statement.condition = RewriteExpression(statement.condition,
+                                                    rewrite)
+            RewriteStatements(statement.statements, rewrite)
+            if isinstance(statement, If) and statement.else_statements:
+                RewriteStatements(statement.else_statements, rewrite)
+        elif isinstance(statement, Do):
+            statement.call = RewriteExpression(statement.call, rewrite)
+        elif statement.value != None:  # Return
+            statement.value = RewriteExpression(statement.value, rewrite)
+
+
+def RewriteClass(class_node, rewrite):
+    # applies rewrite to every expression; returns the number of nodes
+    # rewrite replaced
+    hits = [0]
+
+    def counted(node):
+        new_node = rewrite(node)
+        if new_node is not node:
+            hits[0] += 1
+        return new_node
+    for subroutine in class_node.subroutines:
+        RewriteStatements(subroutine.statements, counted)
+    return hits[0]
+
+
+def Divide(x, y):
+    # Math.divide rounds towards zero
+    quotient = abs(x) // abs(y)
+    return -quotient if (x < 0) != (y < 0) else quotient
+
+
+# folded results of constant operands; None when the OS would not give the
+# same result. Like the Hack code, < and > look at the 16-bit x-y, which
+# overflows.
+BINARY_FOLDS = {'+': lambda x, y: x + y,
+                '-': lambda x, y: x - y,
+                '*': lambda x, y: x * y,
+                '/': lambda x, y: Divide(x, y) if y else None,
+                '&': lambda x, y: x & y,
+                '|': lambda x, y: x | y,
+                '<': lambda x, y: -1 if (x - y) & 0x8000 else 0,
+                '>': lambda x, y: -1 if 0 < (x - y) & 0xFFFF < 0x8000 else 0,
+                '=': lambda x, y: -1 if x == y else 0}
+UNARY_FOLDS = {'-': lambda x: -x,
+               '~': lambda x: ~x}
+# 'push constant' takes 0..32767, negative values are pushed with 'neg'
+MIN_CONSTANT = -0x7FFF
+MAX_CONSTANT = 0x7FFF
+
+
+def FoldConstant(node):
+    value = None
+    if isinstance(node, Binary):
+        x = ConstantValue(node.left)
+        y = ConstantValue(node.right)
+        if x != None and y != None:
+            value = BINARY_FOLDS[node.op](x, y)
+    elif isinstance(node, Unary):
+        x = ConstantValue(node.operand)
+        if x != None:
+            value = UNARY_FOLDS[node.op](x)
+    if value == None or not MIN_CONSTANT <= value <= MAX_CONSTANT:
+        return node
+    return IntegerConstant(value)
+
+
+def FoldConstants(class_node):
+    return RewriteClass(class_node, FoldConstant)
+
+
+def ReduceOperation(node):
+    # x+0, x-0, x|0, x*1, x/1 -> x, pure x*0 -> 0 and variable x*2 -> x+x,
+    # which saves a call to Math.multiply
+    if not isinstance(node, Binary):
+        return node
+    left = ConstantValue(node.left)
+    right = ConstantValue(node.right)
+    if right == 0 and node.op in '+-|':
+        return node.left
+    if left == 0 and node.op in '+|':
+        return node.right
+    if node.op == '*':
+        if right == 1:
+            return node.left
+        if left == 1:
+            return node.right
+        if (right == 0 and IsPure(node.left)) or (left == 0
+                                                  and IsPure(node.right)):
+            return IntegerConstant(0)
+        if right == 2 and isinstance(node.left, VarRef):
+            return Binary('+', node.left, node.left)
+        if left == 2 and isinstance(node.right, VarRef):
+            return Binary('+', node.right, node.right)
+    if node.op == '/' and right == 1:
+        return node.left
+    return node
+
+
+def ReduceStrength(class_node):
+    return RewriteClass(class_node, ReduceOperation)
+
+
+def PruneStatements(statements, hits):
+    # statements without constant-false branches and loops and without
+    # statements after a return; branches on true are inlined
+    out = []
+    for statement in statements:
+        if out and isinstance(out[-1], Return):
+            hits[0] += 1
+            continue
+        if isinstance(statement, (If, While)):
+            statement.statements = PruneStatements(statement.statements,
+                                                   hits)
+            condition = ConstantValue(statement.condition)
+        if isinstance(statement, If):
+            if statement.else_statements:
+                statement.else_statements = PruneStatements(
+                    statement.else_statements, hits)
+            # the VM branches on 'not condition', so only true (-1) takes
+            # the then-branch for sure and only false (0) the else-branch
+            if condition in [-1, 0]:
+                hits[0] += 1
+                taken = (statement.statements if condition
+                         else statement.else_statements or [])
+                for inner in taken:
+                    if not (out and isinstance(out[-1], Return)):
+                        out.append(inner)
+                continue
+        elif isinstance(statement, While) and condition == 0:
+            hits[0] += 1
+            continue
+        out.append(statement)
+    return out
+
+
+def RemoveDeadCode(class_node):
+    hits = [0]
+    for subroutine in class_node.subroutines:
+        subroutine.statements = PruneStatements(subroutine.statements, hits)
+    return hits[0]
+
+
+# Applied in order; folding first so the later passes see constants
+PASSES = [('fold', FoldConstants),
+          ('strength', ReduceStrength),
+          ('dead-code', RemoveDeadCode)]
+
+
+def Optimize(class_node, passes=PASSES):
+    # returns how many nodes each pass rewrote or removed
+    hits = {}
+    for name, optimize_pass in passes:
+        hits[name] = hits.get(name, 0) + optimize_pass(class_node)
+    return hits
+
+
+class VMEmitter(object):
+    # Writes a Class node as VM code, the way CompilationEngine does while
+    # parsing
+
+    def __init__(self, output_filename):
+        self.symbol_table = SymbolTable()
+        self.vm_writer = VMWriter(output_filename)
+        self.if_count = 0
+        self.while_count = 0
+
+    def emitClass(self, node):
+        self.class_name = node.name
+        for var_dec in node.var_decs:
+            self.defineVars(var_dec)
+        for subroutine in node.subroutines:
+            self.emitSubroutine(subroutine)
+
+    def defineVars(self, var_dec):
+        for name in var_dec.names:
+            self.symbol_table.define(name, var_dec.type, var_dec.kind)
+
+    def emitSubroutine(self, node):
+        self.symbol_table.startSubroutine()
+        if node.kind == 'method':
+            self.symbol_table.define('this', self.class_name, VarKind.ARG)
+        for var_type, var_name in node.params:
+            self.symbol_table.define(var_name, var_type, VarKind.ARG)
+        for var_dec in node.var_decs:
+            self.defineVars(var_dec)
+        func_name = self.class_name + '.' + node.name
+        local_count = self.symbol_table.varCount(VarKind.VAR)
+        self.vm_writer.writeFunction(func_name, local_count)
+        if node.kind == 'constructor':
+            field_count = self.symbol_table.varCount(VarKind.FIELD)
+            self.vm_writer.writePush('constant', field_count)
+            self.vm_writer.writeCall('Memory.alloc', 1)
+            self.vm_writer.writePop('pointer', 0)
+        elif node.kind == 'method':
+            self.vm_writer.writePush('argument', 0)
+            self.vm_writer.writePop('pointer', 0)
+        self.emitStatements(node.statements)
+
+    def emitStatements(self, statements):
+        for statement in statements:
+            getattr(self, 'emit' + type(statement).__name__)(statement)
+
+    def pushVar(self, name):
+        self.vm_writer.writePush(self.symbol_table.KindOf(name),
+                                 self.symbol_table.IndexOf(name))
+
+    def emitLet(self, node):
+        if node.index != None:
+            self.pushVar(node.name)
+            self.emitExpression(node.index)
+            self.vm_writer.writeArithmetic('add')
+            self.emitExpression(node.value)
+            self.vm_writer.writePop('temp', 0)
+            self.vm_writer.writePop('pointer', 1)
+            self.vm_writer.writePush('temp', 0)
+            self.vm_writer.writePop('that', 0)
+        else:
+            self.emitExpression(node.value)
+            self.vm_writer.writePop(self.symbol_table.KindOf(node.name),
+                                    self.symbol_table.IndexOf(node.name))
+
+    def emitWhile(self, node):
+        label_prefix = 'WHILE.'+str(self.while_count)
+        self.while_count += 1
+        # label for start of the while loop
+        self.vm_writer.writeLabel(label_prefix+'.L1')
+        self.emitExpression(node.condition)
+        self.vm_writer.writeArithmetic('not')
+        self.vm_writer.writeIf(label_prefix+'.L2')
+        self.emitStatements(node.statements)
+        self.vm_writer.writeGoto(label_prefix+'.L1')
+        # label for end of the while loop
+        self.vm_writer.writeLabel(label_prefix+'.L2')
+
+    def emitIf(self, node):
+        label_prefix = 'IF.'+str(self.if_count)
+        self.if_count += 1
+        self.emitExpression(node.condition)
+        self.vm_writer.writeArithmetic('not')
+        self.vm_writer.writeIf(label_prefix+'.L1')
+        self.emitStatements(node.statements)
+        self.vm_writer.writeGoto(label_prefix+'.L2')
+        # label for else statement
+        self.vm_writer.writeLabel(label_prefix+'.L1')
+        if node.else_statements != None:
+            self.emitStatements(node.else_statements)
+        # label for end of if statement
+        self.vm_writer.writeLabel(label_prefix+'.L2')
+
+    def emitDo(self, node):
+        self.emitCall(node.call)
+        # pop return value to temp
+        self.vm_writer.writePop('temp', 0)
+
+    def emitReturn(self, node):
+        if node.value != None:
+            self.emitExpression(node.value)
+        else:
+            self.vm_writer.writePush('constant', 0)
+        self.vm_writer.writeReturn()
+
+    def emitExpression(self, node):
+        getattr(self, 'emit' + type(node).__name__)(node)
+
+    def emitIntegerConstant(self, node):
+        self.vm_writer.writePush('constant', node.value)
+
+    def emitStringConstant(self, node):
+        self.vm_writer.writePush('constant', len(node.value))
+        self.vm_writer.writeCall('String.new', 1)
+        for c in node.value:
+            self.vm_writer.writePush('constant', ord(c))
+            self.vm_writer.writeCall('String.appendChar', 2)
+
+    def emitKeywordConstant(self, node):
+        attr = KEYWORD_CONSTANTS_TABLE[node.keyword]
+        self.vm_writer.writePush(attr[0], attr[1])
+
+    def emitVarRef(self, node):
+        self.pushVar(node.name)
+
+    def emitArrayRef(self, node):
+        self.pushVar(node.name)
+        self.emitExpression(node.index)
+        self.vm_writer.writeArithmetic('add')
+        self.vm_writer.writePop('pointer', 1)
+        self.vm_writer.writePush('that', 0)
+
+    def emitCall(self, node):
+        arg_count = len(node.args)
+        if node.receiver == None:
+            sub_name = self.class_name + '.' + node.name
+            arg_count += 1
+            self.vm_writer.writePush('pointer', 0)
+        elif self.symbol_table.hasVar(node.receiver):
+            sub_name = (self.symbol_table.TypeOf(node.receiver) + '.' +
+                        node.name)
+            arg_count += 1
+            self.pushVar(node.receiver)
+        else:
+            sub_name = node.receiver + '.' + node.name
+        for arg in node.args:
+            self.emitExpression(arg)
+        self.vm_writer.writeCall(sub_name, arg_count)
+
+    def emitUnary(self, node):
+        self.emitExpression(node.operand)
+        self.vm_writer.writeArithmetic(UNARY_OP_TABLE[node.op])
+
+    def emitBinary(self, node):
+        self.emitExpression(node.left)
+        self.emitExpression(node.right)
+        self.vm_writer.writeArithmetic(OP_TABLE[node.op])
+
+
+def CompileClass(input_filename, output_filename, passes=PASSES):
+    # returns the hits of each pass
+    class_node = AstBuilder(input_filename).parseClass()
+    hits = Optimize(class_node, passes)
+    VMEmitter(output_filename).emitClass(class_node)
+    return hits
+
+
+def PrintReport(hits):
+    for name, _ in PASSES:
+        print('%-20s %d'%(name, hits.get(name, 0)))
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    if not args:
+        print('Usage: %s [--passes=name,...] [--report] filename/dirname'
+              %sys.argv[0])
+        sys.exit(1)
+    passes = PASSES
+    for flag in flags:
+        if flag.startswith('--passes='):
+            names = flag.split('=')[1].split(',')
+            passes = [(name, optimize_pass) for name, optimize_pass in PASSES
+                      if name in names]
+    inputpath = os.path.relpath(args[0])
+    hits = {}
+    for inputfile in ListJackFile(inputpath):
+        outputfile = '.'.join(inputfile.split('.')[:-1]) + '.vm'
+        for name, count in CompileClass(inputfile, outputfile,
+                                        passes).items():
+            hits[name] = hits.get(name, 0) + count
+    if '--report' in flags:
+        PrintReport(hits)
+
+
+if __name__ == '__main__':
+    main()
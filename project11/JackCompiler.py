@@ -5,9 +5,11 @@ Created on Sun Oct 29 18:53:46 2017
 @author: zheng
 """
 
+import array
 import sys
 import enum
 import os
+import re
 
 
 class TokenType(enum.Enum):
@@ -47,91 +49,155 @@ KEYWORD_CONSTANTS_TABLE = {'true': ('constant', -1),
                            'false': ('constant', 0), 
                            'null': ('constant', 0), 
                            'this': ('pointer', 0)}
-    
+
+
+# Skips spaces and comments, then matches one token. Comments may start
+# and end anywhere; an unclosed comment or string, or any other character,
+# is an error. Only spaces and comments are left when no group matches.
+TOKEN_PATTERN = re.compile(r'''
+    (?:\s+|//[^\n]*|/\*.*?\*/)*
+    (?:(?P<integer>[0-9]+)
+     | "(?P<string>[^"\n]*)"
+     | (?P<unclosed>/\*|")
+     | (?P<symbol>[{}()\[\].,;+\-*/&|<>=~])
+     | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+     | (?P<error>.)
+     | $)
+''', re.DOTALL | re.VERBOSE)
+
+KEYWORD_LIST = ['class', 'constructor', 'function', 'method', 'field',
+                'static', 'var', 'int', 'char', 'boolean', 'void', 'true',
+                'false', 'null', 'this', 'let', 'do', 'if', 'else', 'while',
+                'return']
+
+SYMBOL_LIST = ['{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*',
+               '/', '&', '|', '<', '>', '=', '~']
+
+# Every string table starts with the keywords and symbols, so their ids are
+# the same in every file and the parser can compare ids instead of strings.
+TOKEN_IDS = dict((token, index) for index, token
+                 in enumerate(KEYWORD_LIST + SYMBOL_LIST))
+
+KEYWORDS = frozenset(KEYWORD_LIST)
+
+TOKEN_TYPES = dict((token_type.value, token_type) for token_type in TokenType)
+
+# type codes in TokenStream.types
+(KEYWORD_TYPE, SYMBOL_TYPE, INTEGER_TYPE, STRING_TYPE,
+ IDENTIFIER_TYPE) = [token_type.value for token_type in TokenType]
+
+# ids of the keywords and symbols the parser checks
+(CLASS_ID, STATIC_ID, FIELD_ID, CONSTRUCTOR_ID, FUNCTION_ID, METHOD_ID, VAR_ID,
+ LET_ID, DO_ID, IF_ID, ELSE_ID, WHILE_ID, RETURN_ID) = [
+    TOKEN_IDS[token] for token in ['class', 'static', 'field', 'constructor',
+                                   'function', 'method', 'var', 'let', 'do',
+                                   'if', 'else', 'while', 'return']]
+OPEN_PAREN_ID, OPEN_BRACKET_ID, DOT_ID, COMMA_ID = [TOKEN_IDS[token]
+                                                    for token in '([.,']
+
+OP_IDS = dict((TOKEN_IDS[op], command) for op, command in OP_TABLE.items())
+UNARY_OP_IDS = dict((TOKEN_IDS[op], command)
+                    for op, command in UNARY_OP_TABLE.items())
+KEYWORD_CONSTANT_IDS = dict((TOKEN_IDS[keyword], value)
+                            for keyword, value in KEYWORD_CONSTANTS_TABLE.items())
+TERM_TYPES = frozenset([INTEGER_TYPE, STRING_TYPE, IDENTIFIER_TYPE])
+TERM_IDS = frozenset(list(KEYWORD_CONSTANT_IDS) + list(UNARY_OP_IDS)
+                     + [OPEN_PAREN_ID])
+
+GROUP_TYPES = {'integer': INTEGER_TYPE,
+               'string': STRING_TYPE,
+               'symbol': SYMBOL_TYPE,
+               'word': IDENTIFIER_TYPE}
+
+
+def LineColumn(text, offset):
+    # both from 1
+    return (text.count('\n', 0, offset) + 1,
+            offset - text.rfind('\n', 0, offset))
+
+
+class TokenStream(object):
+    # Parallel arrays, one entry per token: the TokenType value, the index of
+    # the token in the string table and its offset in text.
+    __slots__ = ('text', 'types', 'ids', 'offsets', 'strings')
+
+    def __init__(self, text):
+        self.text = text
+        self.types = array.array('B')
+        self.ids = array.array('I')
+        self.offsets = array.array('I')
+        self.strings = []
+
+
+def Tokenize(text, filename='<input>'):
+    # scans the whole text in one pass
+    stream = TokenStream(text)
+    types = stream.types
+    ids = stream.ids
+    offsets = stream.offsets
+    table = dict(TOKEN_IDS)
+    for match in TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == None:
+            break
+        token = match.group(kind)
+        token_type = GROUP_TYPES.get(kind)
+        if token_type == None:
+            raise ValueError('%s:%d:%d: unexpected %r'
+                             %((filename,) + LineColumn(text, match.start(kind))
+                               + (token,)))
+        if token_type == IDENTIFIER_TYPE and token in KEYWORDS:
+            token_type = KEYWORD_TYPE
+        types.append(token_type)
+        # new tokens are numbered in order of first appearance
+        ids.append(table.setdefault(token, len(table)))
+        offsets.append(match.start(kind))
+    stream.strings = list(table)
+    return stream
+
+
 class Tokenizer(object):
-    
-    KEYWORD_LIST = ['class', 'constructor', 'function', 'method', 'field', 
-                    'static', 'var', 'int', 'char', 'boolean', 'void', 'true',
-                    'false', 'null', 'this', 'let', 'do', 'if', 'else',
-                    'while', 'return']
-    
-    SYMBOL_LIST = ['{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*',
-                   '/', '&', '|', '<', '>', '=', '~']
+    # A cursor over a TokenStream
+    __slots__ = ('stream', 'index', 'current_type', 'current_id')
     
     def __init__(self, input_filename):
-        self.input = open(input_filename, 'r')
-        self.current_token = None
+        with open(input_filename, 'r') as f:
+            self.stream = Tokenize(f.read(), input_filename)
+        self.index = -1
         self.current_type = None
-        self.current_line = None
-        self.readline()
-        self.advance()
+        self.current_id = None
+        if self.stream.types:
+            self.advance()
         
     def hasMoreTokens(self):
-        return bool(self.current_line)
-    
-    def readline(self):
-        self.current_line = self.input.readline() 
-        while self.current_line:
-            self.current_line = self.current_line.strip()
-            # comment in /** */
-            # assumes /** always at the beginning of a line
-            # and */ always at the end of a line
-            if self.current_line.startswith('/**'):
-                while not self.current_line.endswith('*/'):
-                    self.current_line = self.input.readline() .strip()
-                self.current_line = self.input.readline() 
-                # continue to check /** */ patten
-                continue
-            # comment start with //
-            self.current_line = self.current_line.split('//')[0].strip()
-            if not self.current_line:  # empty line
-                self.current_line = self.input.readline() 
-            else:  # non-empty line
-                break
+        return self.index + 1 < len(self.stream.types)
     
     def advance(self):        
-        def isValidChar(c):
-            return ('0' <= c <= '9' or 'a' <= c <= 'z' or 'A' <= c <= 'Z' or 
-                    c == '_')
-        return_token = self.current_token            
-        line = self.current_line  # alias copy
-        token_len = 1
-        if '0' <= line[0] <= '9':  # integer constant            
-            while token_len < len(line) and '0' <= line[token_len] <= '9':
-                token_len += 1
-            self.current_type = TokenType.INTEGER
-            self.current_token = line[:token_len]
-        elif line[0] == '"':  # string constant
-            while token_len < len(line) and line[token_len] != '"':
-                token_len += 1
-            self.current_type = TokenType.STRING
-            self.current_token = line[1:token_len]
-            token_len += 1
-        elif line[0] in self.SYMBOL_LIST:
-            self.current_type = TokenType.SYMBOL
-            self.current_token = line[0]
-        else:  # identifier or keywords
-            while token_len < len(line) and isValidChar(line[token_len]):
-                token_len += 1
-            self.current_token = line[:token_len]
-            if self.current_token in self.KEYWORD_LIST:
-                self.current_type = TokenType.KEYWORD
-            else: 
-                self.current_type = TokenType.IDENTIFIER
-        
-        self.current_line = line[token_len:].lstrip()
-        if not self.current_line:
-            self.readline()
+        return_token = self.currentToken()
+        self.index += 1
+        self.current_type = self.stream.types[self.index]
+        self.current_id = self.stream.ids[self.index]
         return return_token            
         
     def currentToken(self):
-        return self.current_token
+        if self.current_id == None:
+            return None
+        return self.stream.strings[self.current_id]
     
     def tokenType(self):
-        return self.current_type
+        return TOKEN_TYPES.get(self.current_type)
     
-    def __del__(self):
-        self.input.close()
+    def peek(self, offset=1):
+        # id of the token offset tokens ahead of the current one, or None
+        # past the end
+        index = self.index + offset
+        if index < len(self.stream.ids):
+            return self.stream.ids[index]
+        return None
+    
+    def currentPosition(self):
+        # (line, column) of the current token
+        return LineColumn(self.stream.text, self.stream.offsets[self.index])
         
 
 class CompilationEngine(object):
@@ -156,7 +222,7 @@ class CompilationEngine(object):
         return res
         
     def compileClass(self):
-        if self.tokenizer.currentToken() != 'class':
+        if self.tokenizer.current_id != CLASS_ID:
             return False       
         # class keyword
         self.tokenizer.advance()
@@ -177,25 +243,25 @@ class CompilationEngine(object):
         return True
         
     def compileClassVarDec(self):
-        if self.tokenizer.currentToken() not in ['static', 'field']:
+        if self.tokenizer.current_id not in [STATIC_ID, FIELD_ID]:
             return False
         count = 0
         var_kind = self.VARKIND_MAP[self.tokenizer.advance()]        
         var_type = self.tokenizer.advance()       
-        while self.tokenizer.tokenType() == TokenType.IDENTIFIER:
+        while self.tokenizer.current_type == IDENTIFIER_TYPE:
             # varName
             var_name = self.tokenizer.advance()
             self.symbol_table.define(var_name, var_type, var_kind)
             count += 1
-            if self.tokenizer.currentToken() == ',':
+            if self.tokenizer.current_id == COMMA_ID:
                 self.tokenizer.advance()
         # ';'
         self.tokenizer.advance()
         return count       
     
     def compileSubroutineDec(self):
-        if self.tokenizer.currentToken() not in ['constructor', 'function',
-                                                 'method']:
+        if self.tokenizer.current_id not in [CONSTRUCTOR_ID, FUNCTION_ID,
+                                           METHOD_ID]:
             return False
         self.symbol_table.startSubroutine()
         subroutine_type = self.tokenizer.advance()
@@ -211,13 +277,12 @@ class CompilationEngine(object):
         
     def compileParameterList(self):
         count = 0
-        while (self.tokenizer.tokenType() == TokenType.IDENTIFIER or 
-               self.tokenizer.tokenType() == TokenType.KEYWORD):
+        while self.tokenizer.current_type in [IDENTIFIER_TYPE, KEYWORD_TYPE]:
             var_type = self.tokenizer.advance()
             var_name = self.tokenizer.advance()
             self.symbol_table.define(var_name, var_type, VarKind.ARG)
             count += 1
-            if self.tokenizer.currentToken() == ',':
+            if self.tokenizer.current_id == COMMA_ID:
                 self.tokenizer.advance()
         return count
         
@@ -243,16 +308,16 @@ class CompilationEngine(object):
         return True
 
     def compileVarDec(self):
-        if self.tokenizer.currentToken() != 'var':
+        if self.tokenizer.current_id != VAR_ID:
             return False       
         # kind, type
         var_kind = self.VARKIND_MAP[self.tokenizer.advance()]
         var_type = self.tokenizer.advance()
-        while self.tokenizer.tokenType() == TokenType.IDENTIFIER:
+        while self.tokenizer.current_type == IDENTIFIER_TYPE:
             # varName
             var_name = self.tokenizer.advance()
             self.symbol_table.define(var_name, var_type, var_kind)
-            if self.tokenizer.currentToken() == ',':
+            if self.tokenizer.current_id == COMMA_ID:
                 self.tokenizer.advance()
         # ';'
         self.tokenizer.advance()
@@ -268,13 +333,13 @@ class CompilationEngine(object):
         return True
     
     def compileLet(self):
-        if self.tokenizer.currentToken() != 'let':
+        if self.tokenizer.current_id != LET_ID:
             return False
         lhs_array = False
         # let
         self.tokenizer.advance()
         lhs = self.tokenizer.advance()
-        if self.tokenizer.currentToken() == '[':
+        if self.tokenizer.current_id == OPEN_BRACKET_ID:
             self.vm_writer.writePush(self.symbol_table.KindOf(lhs),
                                      self.symbol_table.IndexOf(lhs))
             lhs_array = True
@@ -296,7 +361,7 @@ class CompilationEngine(object):
         return True
     
     def compileWhile(self):
-        if self.tokenizer.currentToken() != 'while':
+        if self.tokenizer.current_id != WHILE_ID:
             return False
         label_prefix = 'WHILE.'+str(self.while_count)
         self.while_count += 1
@@ -314,7 +379,7 @@ class CompilationEngine(object):
         return True
         
     def compileIf(self):
-        if self.tokenizer.currentToken() != 'if':
+        if self.tokenizer.current_id != IF_ID:
             return False
         label_prefix = 'IF.'+str(self.if_count)
         self.if_count += 1
@@ -327,7 +392,7 @@ class CompilationEngine(object):
         self.vm_writer.writeGoto(label_prefix+'.L2')
         # label for else statement
         self.vm_writer.writeLabel(label_prefix+'.L1')
-        if self.tokenizer.currentToken() == 'else':
+        if self.tokenizer.current_id == ELSE_ID:
             # else
             self.tokenizer.advance()
             self.compileBracketSyntax(self.compileStatements)
@@ -339,12 +404,12 @@ class CompilationEngine(object):
         arg_count = 0
         # subroutine name | className | varName
         first_name = first_name_in or self.tokenizer.advance()
-        if self.tokenizer.currentToken() == '(':
+        if self.tokenizer.current_id == OPEN_PAREN_ID:
             sub_name = self.class_name + '.' + first_name
             # assume function calls are always in the format of XXX.xxx
             arg_count = 1
             self.vm_writer.writePush('pointer', 0)
-        elif self.tokenizer.currentToken() == '.':
+        elif self.tokenizer.current_id == DOT_ID:
             # '.'
             self.tokenizer.advance()
             last_name = self.tokenizer.advance()
@@ -361,7 +426,7 @@ class CompilationEngine(object):
         self.vm_writer.writeCall(sub_name, arg_count)
         
     def compileDo(self):
-        if self.tokenizer.currentToken() != 'do':
+        if self.tokenizer.current_id != DO_ID:
             return False
         # do
         self.tokenizer.advance()
@@ -373,7 +438,7 @@ class CompilationEngine(object):
         return True
     
     def compileReturn(self):
-        if self.tokenizer.currentToken() != 'return':
+        if self.tokenizer.current_id != RETURN_ID:
             return False
         # return
         self.tokenizer.advance()
@@ -388,7 +453,7 @@ class CompilationEngine(object):
         count = 0
         if self.compileExpression():
             count += 1
-            while self.tokenizer.currentToken() == ',':
+            while self.tokenizer.current_id == COMMA_ID:
                 # ','
                 self.tokenizer.advance()
                 self.compileExpression()
@@ -396,58 +461,58 @@ class CompilationEngine(object):
         return count
     
     def isTerm(self):
-        return (self.tokenizer.tokenType() == TokenType.INTEGER or
-                self.tokenizer.tokenType() == TokenType.STRING or
-                self.tokenizer.tokenType() == TokenType.IDENTIFIER or
-                self.tokenizer.currentToken() in KEYWORD_CONSTANTS_TABLE or
-                self.tokenizer.currentToken() == '(' or
-                self.tokenizer.currentToken() in UNARY_OP_TABLE)
+        return (self.tokenizer.current_type in TERM_TYPES or
+                self.tokenizer.current_id in TERM_IDS)
     
     def compileExpression(self):
         if not self.isTerm():
             return False
         self.compileTerm()
-        while self.tokenizer.currentToken() in OP_TABLE:
-            op = self.tokenizer.advance()
+        while self.tokenizer.current_id in OP_IDS:
+            command = OP_IDS[self.tokenizer.current_id]
+            self.tokenizer.advance()
             self.compileTerm()
-            self.vm_writer.writeArithmetic(OP_TABLE[op])
+            self.vm_writer.writeArithmetic(command)
         return True        
         
     def compileTerm(self):
         if not self.isTerm():
             return False
-        if self.tokenizer.tokenType() == TokenType.INTEGER:
+        if self.tokenizer.current_type == INTEGER_TYPE:
             self.vm_writer.writePush('constant', self.tokenizer.advance())
-        elif self.tokenizer.currentToken() in KEYWORD_CONSTANTS_TABLE:
-            attr = KEYWORD_CONSTANTS_TABLE[self.tokenizer.advance()]
-            self.vm_writer.writePush(attr[0], attr[1])
-        elif self.tokenizer.tokenType() == TokenType.STRING:
+        elif self.tokenizer.current_type == STRING_TYPE:
             str_val = self.tokenizer.advance()
             self.vm_writer.writePush('constant', len(str_val))
             self.vm_writer.writeCall('String.new', 1)
             for c in str_val:
                 self.vm_writer.writePush('constant', ord(c))
                 self.vm_writer.writeCall('String.appendChar', 2)
-        elif self.tokenizer.tokenType() == TokenType.IDENTIFIER:
+        elif self.tokenizer.current_id in KEYWORD_CONSTANT_IDS:
+            attr = KEYWORD_CONSTANT_IDS[self.tokenizer.current_id]
+            self.tokenizer.advance()
+            self.vm_writer.writePush(attr[0], attr[1])
+        elif self.tokenizer.current_type == IDENTIFIER_TYPE:
+            next_id = self.tokenizer.peek()
             first_name = self.tokenizer.advance()
-            if self.tokenizer.currentToken() == '[':
+            if next_id == OPEN_BRACKET_ID:
                 self.vm_writer.writePush(self.symbol_table.KindOf(first_name),
                                          self.symbol_table.IndexOf(first_name))
                 self.compileBracketSyntax(self.compileExpression)
                 self.vm_writer.writeArithmetic('add')
                 self.vm_writer.writePop('pointer', 1)
                 self.vm_writer.writePush('that', 0)
-            elif self.tokenizer.currentToken() in ['.', '(']:
+            elif next_id in [DOT_ID, OPEN_PAREN_ID]:
                 self.compileSubroutineCall(first_name)
             else:  # variable
                 self.vm_writer.writePush(self.symbol_table.KindOf(first_name),
                                          self.symbol_table.IndexOf(first_name))                
-        elif self.tokenizer.currentToken() == '(':
+        elif self.tokenizer.current_id == OPEN_PAREN_ID:
             self.compileBracketSyntax(self.compileExpression)                             
-        elif self.tokenizer.currentToken() in UNARY_OP_TABLE:
-            op = self.tokenizer.advance()
+        elif self.tokenizer.current_id in UNARY_OP_IDS:
+            command = UNARY_OP_IDS[self.tokenizer.current_id]
+            self.tokenizer.advance()
             self.compileTerm()
-            self.vm_writer.writeArithmetic(UNARY_OP_TABLE[op])
+            self.vm_writer.writeArithmetic(command)
         return True
 
 
@@ -497,7 +562,12 @@ class SymbolTable(object):
 
 class VMWriter(object):
     def __init__(self, output_filename):
-        self.output = open(output_filename, 'w')
+        # output_filename may also be an open stream, which is left open
+        self.owns_output = isinstance(output_filename, str)
+        if self.owns_output:
+            self.output = open(output_filename, 'w')
+        else:
+            self.output = output_filename
     
     def writeFunction(self, func_name, n_locals):
         self.output.write('function %s %d\n'%(func_name, n_locals))
@@ -534,7 +604,8 @@ class VMWriter(object):
         self.output.write('goto %s\n'%label)
         
     def __del__(self):
-        self.output.close()
+        if self.owns_output:
+            self.output.close()
 
 
 def ListJackFile(path):
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Builds Jack programs into Hack machine code in one process: Jack -> VM ->
+Hack, passing every stage through memory. The VM translator hands its
+instructions straight to the linker's object builder, which encodes them
+without any assembly text; the .asm file is only written as the --keep
+listing. In object mode every class becomes a relocatable object and the
+objects are linked, so classes shipped only as prebuilt .hacko objects
+(e.g. the OS) can be linked in.
+With --ast the Jack classes are compiled through JackAST and its passes.
+"""
+
+import io
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'project6'))
+sys.path.insert(0, os.path.join(ROOT, 'project8'))
+
+import JackAST
+import JackCompiler
+import linker
+import VMtranslator
+
+
+def ListSources(path):
+    # Jack files, plus prebuilt VM files and objects (e.g. OS classes) that
+    # have no source next to them
+    ret = []
+    if os.path.isfile(path):
+        base = '.'.join(path.split('.')[:-1])
+        if path.endswith('.jack'):
+            ret = [path]
+        elif path.endswith('.vm'):
+            if not os.path.isfile(base + '.jack'):
+                ret = [path]
+        elif path.endswith('.hacko'):
+            if not (os.path.isfile(base + '.jack')
+                    or os.path.isfile(base + '.vm')):
+                ret = [path]
+    else:
+        files = [os.path.join(path, file) for file in os.listdir(path)]
+        for file in files:
+            ret.extend(ListSources(file))
+    return ret
+
+
+def CompileJack(inputfile, ast=False):
+    output = io.StringIO()
+    if ast:
+        JackAST.CompileClass(inputfile, output)
+    else:
+        compilation_engine = JackCompiler.CompilationEngine(inputfile, output)
+        compilation_engine.compileClass()
+    return output.getvalue()
+
+
+def WriteFile(filename, text):
+    with open(filename, 'w') as f:
+        f.write(text)
+
+
+def TranslateObject(vm_file, commands):
+    # one VM file translated on its own from ROM address 0, encoded into an
+    # object as it is written
+    builder = linker.ObjectBuilder()
+    writer = VMtranslator.CodeWriter(builder)
+    # labels of code outside functions are unique to the file
+    writer.setFileName(vm_file)
+    writer.function_name = writer.filename
+    VMtranslator.TranslateCommands(writer, vm_file, commands)
+    return builder.Finish(writer.relocations)
+
+
+def BuildObjects(basename, vm_files, keep=False, packed=False):
+    # one object per VM file, plus one for the bootstrap code; vm_files
+    # with no text are prebuilt objects
+    objects = []
+    if any([os.path.split(file)[1] in ['Sys.vm', 'Sys.hacko']
+            for file, _ in vm_files]):
+        builder = linker.ObjectBuilder()
+        writer = VMtranslator.CodeWriter(builder)
+        writer.writeInit()
+        objects.append(builder.Finish(writer.relocations))
+    for vm_file, vm_text in vm_files:
+        if vm_text == None:
+            objects.append(linker.ReadObject(vm_file))
+            continue
+        obj = TranslateObject(
+            vm_file, VMtranslator.ReadCommands(io.StringIO(vm_text)))
+        if keep:
+            linker.WriteObject('.'.join(vm_file.split('.')[:-1]) + '.hacko',
+                               obj)
+        objects.append(obj)
+    words, symbols = linker.Link(objects)
+    outfile = basename + ('.hackb' if packed else '.hack')
+    linker.WriteRom(outfile, words, symbols, packed)
+    return outfile
+
+
+def Build(inputpath, keep=False, packed=False, objects=False, ast=False):
+    if os.path.isfile(inputpath):
+        basename = '.'.join(inputpath.split('.')[:-1])
+    else:
+        basename = os.path.join(inputpath, os.path.split(inputpath)[1])
+    # Jack -> VM
+    vm_files = []
+    for inputfile in ListSources(inputpath):
+        if inputfile.endswith('.hacko'):
+            vm_files.append((inputfile, None))
+            continue
+        if inputfile.endswith('.jack'):
+            vm_file = '.'.join(inputfile.split('.')[:-1]) + '.vm'
+            vm_text = CompileJack(inputfile, ast)
+            if keep:
+                WriteFile(vm_file, vm_text)
+        else:
+            vm_file = inputfile
+            with open(vm_file, 'r') as f:
+                vm_text = f.read()
+        vm_files.append((vm_file, vm_text))
+    if objects or any([vm_text == None for _, vm_text in vm_files]):
+        return BuildObjects(basename, vm_files, keep, packed)
+    # VM -> Hack, encoding instructions as the translator writes them; the
+    # assembly is only written out as a listing with --keep
+    listing = None
+    if keep:
+        listing = VMtranslator.AsmOutput(open(basename + '.asm', 'w'))
+    builder = linker.ObjectBuilder(listing)
+    writer = VMtranslator.CodeWriter(builder)
+    if any(['Sys.vm' in vm_file for vm_file, _ in vm_files]):
+        writer.writeInit()
+    for vm_file, vm_text in vm_files:
+        VMtranslator.TranslateFile(writer, vm_file, io.StringIO(vm_text))
+    writer.Close()
+    words, symbols = linker.Link([builder.Finish(writer.relocations)])
+    outfile = basename + ('.hackb' if packed else '.hack')
+    linker.WriteRom(outfile, words, symbols, packed)
+    return outfile
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    if not args:
+        print('Usage: %s [--keep] [--packed] [--objects] [--ast] '
+              'filename/dirname'%sys.argv[0])
+        sys.exit(1)
+    inputpath = os.path.relpath(args[0])
+    Build(inputpath, '--keep' in flags, '--packed' in flags,
+          '--objects' in flags, '--ast' in flags)
+
+
+if __name__ == '__main__':
+    main()
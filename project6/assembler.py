@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
+import array
 import copy
+import hashlib
+import multiprocessing
+import os
+import pickle
+import struct
 import sys
 
 SYM_TABLE_DEFAULT = {'R0': 0, 'R1': 1, 'R2': 2, 'R3': 3, 'R4': 4, 'R5': 5,
@@ -15,7 +21,7 @@ JUMP_TABLE = {None: '000', 'JGT': '001', 'JEQ': '010', 'JGE': '011',
               'JLT': '100', 'JNE': '101', 'JLE': '110', 'JMP': '111'}
 
 CMD_TABLE = {'0': '0101010', '1': '0111111', '-1': '0111010',
-             'D': '0001100', 'A': '0110000', '!D': '001101',
+             'D': '0001100', 'A': '0110000', '!D': '0001101',
              '!A': '0110001', '-D': '0001111', '-A': '0110011',
              'D+1': '0011111', 'A+1': '0110111', 'D-1': '0001110',
              'A-1': '0110010', 'D+A': '0000010', 'D-A': '0010011',
@@ -25,11 +31,127 @@ CMD_TABLE = {'0': '0101010', '1': '0111111', '-1': '0111010',
              'D-M': '1010011', 'M-D': '1000111', 'D&M': '1000000',
              'D|M': '1010101'}
 
+C_PREFIX = 0b111 << 13
+DEST_CODES = dict((k, int(v, 2) << 3) for k, v in DEST_TABLE.items())
+JUMP_CODES = dict((k, int(v, 2)) for k, v in JUMP_TABLE.items())
+CMD_CODES = dict((k, int(v, 2) << 6) for k, v in CMD_TABLE.items())
+
+# Kinds of parsed source lines
+LINE_EMPTY = 0
+LINE_LABEL = 1
+LINE_SYMBOL = 2  # A instruction whose value comes from the symbol table
+LINE_WORD = 3  # fully encoded instruction
+
+# Compiler generated assembly repeats a small set of lines thousands of
+# times, so parsed lines are cached by their exact text. Labels are unique
+# and never cached; the limit keeps the cache bounded on huge inputs.
+LINE_CACHE = {}
+LINE_CACHE_LIMIT = 1 << 16
+C_INSTRUCTION_CACHE = {}
+
+# Packed ROM: header, little-endian 16-bit words, then the symbol table as
+# 'name value' lines. The symbol table offset is 0 when there is none.
+PACKED_HEADER = struct.Struct('<4sII')
+PACKED_MAGIC = b'HACK'
+
+
+def PackSymbols(symbols):
+  return ''.join('%s %d\n'%(sym, value)
+                 for sym, value in symbols.items()).encode()
+
+
+def WritePacked(outfile, words, symbols=None):
+  words = array.array('H', words)
+  if sys.byteorder == 'big':
+    words.byteswap()
+  data = words.tobytes()
+  symtab = b''
+  symtab_offset = 0
+  if symbols:
+    symtab = PackSymbols(symbols)
+    symtab_offset = PACKED_HEADER.size + len(data)
+  with open(outfile, 'wb') as f:
+    f.write(PACKED_HEADER.pack(PACKED_MAGIC, len(words), symtab_offset)
+            + data + symtab)
+
+
+def ReadPacked(infile):
+  with open(infile, 'rb') as f:
+    data = f.read()
+  magic, count, symtab_offset = PACKED_HEADER.unpack_from(data)
+  assert magic == PACKED_MAGIC
+  words = array.array('H')
+  words.frombytes(data[PACKED_HEADER.size:PACKED_HEADER.size+2*count])
+  if sys.byteorder == 'big':
+    words.byteswap()
+  symbols = {}
+  if symtab_offset:
+    for line in data[symtab_offset:].decode().splitlines():
+      sym, value = line.split()
+      symbols[sym] = int(value)
+  return words, symbols
+
+
+def EncodeCInstruction(line):
+  dest = None
+  jump = None
+  ind_dest = line.find('=')
+  if ind_dest != -1:
+    dest = line[:ind_dest].strip()
+    line = line[ind_dest+1:].strip()
+  ind_jump = line.rfind(';')
+  if ind_jump != -1:
+    jump = line[ind_jump+1:].strip()
+    line = line[:ind_jump].strip()
+  key = (line, dest, jump)
+  word = C_INSTRUCTION_CACHE.get(key, None)
+  if word == None:
+    word = C_PREFIX | CMD_CODES[line] | DEST_CODES[dest] | JUMP_CODES[jump]
+    C_INSTRUCTION_CACHE[key] = word
+  return word
+
+
+def ParseLine(line):
+  entry = LINE_CACHE.get(line, None)
+  if entry != None:
+    return entry
+  # Remove comments
+  text = line
+  ind_comment = text.find('//')
+  if ind_comment != -1:
+    text = text[:ind_comment]
+  text = text.strip()
+  if not text:
+    entry = (LINE_EMPTY, None)
+  elif text.startswith('('):
+    return (LINE_LABEL, text[1:-1])
+  elif text.startswith('@'):
+    sym = text[1:]
+    if sym.isdigit():
+      entry = (LINE_WORD, int(sym))
+    else:
+      entry = (LINE_SYMBOL, sym)
+  else:
+    entry = (LINE_WORD, EncodeCInstruction(text))
+  if len(LINE_CACHE) < LINE_CACHE_LIMIT:
+    LINE_CACHE[line] = entry
+  return entry
+
+
+def FormatWord(word):
+  return format(word, '016b')
+
+
+def UserSymbols(sym_table):
+  return dict((sym, value) for sym, value in sym_table.items()
+              if sym not in SYM_TABLE_DEFAULT)
+
 
 class Assembler(object):
-  def __init__(self, infile):
+  def __init__(self, infile, packed=False):
     infile = infile.strip()
     self.infile = infile
+    self.packed = packed
     self.text, self.outfile = self.ReadFile(infile)
     self.lines = self.text.split('\n')
     self.sym_table = copy.copy(SYM_TABLE_DEFAULT)
@@ -38,82 +160,303 @@ class Assembler(object):
     assert infile[-4:] == '.asm'
     with open(infile, 'r') as f:
       data = f.read()
-    outfile = infile[:-4] + '.hack'
+    outfile = infile[:-4] + ('.hackb' if self.packed else '.hack')
     return data, outfile
 
   def FirstPass(self):
     line_num = 0
     for line in self.lines:
-      line = line.strip()
-      if not line or line.startswith('//'):
-        continue
-      if line.startswith('(') and line.endswith(')'):
-        sym = line[1:-1]
-        self.sym_table[sym] = line_num
-      else:
+      kind, value = ParseLine(line)
+      if kind == LINE_LABEL:
+        self.sym_table[value] = line_num
+      elif kind != LINE_EMPTY:
         line_num += 1
 
   def SecondPass(self):
     mem_avail = 16
     self.instructions = []
     for line in self.lines:
-      # Remove comments
-      ind_comment = line.find('//')
-      if ind_comment != -1:
-        line = line[:ind_comment]
-      line = line.strip()
-      # Skip empty line and labels
-      if not line or line.startswith('('):
-        continue
-      # A instruction
-      if line.startswith('@'):
-        sym = line[1:]
-        try:
-          line_num = int(sym)  # sym is already a number
-        except ValueError:
-          line_num = self.sym_table.get(sym, None)  # exist in sym table
-          if line_num == None:  # first time appear
-            line_num = mem_avail
-            self.sym_table[sym] = mem_avail
-            mem_avail += 1
-        bin_num = bin(line_num)[2:]
-        instruction = '0'*(16-len(bin_num)) + bin_num
-      # D instruction
-      else:
-        dest = None
-        jump = None
-        ind_dest = line.find('=')
-        if ind_dest != -1:
-          dest = line[:ind_dest].strip()
-          line = line[ind_dest+1:].strip()
-        ind_jump = line.rfind(';')
-        if ind_jump != -1:
-          jump = line[ind_jump+1:].strip()
-          line = line[:ind_jump].strip()
-        cmd = line
-        instruction = ('111' + CMD_TABLE[cmd] + DEST_TABLE[dest]
-                       + JUMP_TABLE[jump])
-      # Append instruction
-      self.instructions.append(instruction)
+      kind, value = ParseLine(line)
+      if kind == LINE_WORD:
+        self.instructions.append(value)
+      elif kind == LINE_SYMBOL:
+        address = self.sym_table.get(value, None)
+        if address == None:  # first time appear
+          address = mem_avail
+          self.sym_table[value] = mem_avail
+          mem_avail += 1
+        self.instructions.append(address)
 
   def WriteOutput(self):
+    if self.packed:
+      WritePacked(self.outfile, self.instructions,
+                  UserSymbols(self.sym_table))
+      return
     with open(self.outfile, 'w') as f:
-      for instruction in self.instructions:
-        f.write(instruction)
-        f.write('\n')
+      f.write(''.join([FormatWord(instruction) + '\n'
+                       for instruction in self.instructions]))
 
   def Parse(self):
     self.FirstPass()
     self.SecondPass()
     self.WriteOutput()
 
+
+class StreamingAssembler(Assembler):
+  # Reads the input once and writes every instruction as soon as it is
+  # parsed. Symbols that are not known yet are written as placeholders and
+  # backpatched at the end, so memory only grows with forward references.
+  def __init__(self, infile, packed=False):
+    infile = infile.strip()
+    assert infile[-4:] == '.asm'
+    self.infile = infile
+    self.packed = packed
+    self.outfile = infile[:-4] + ('.hackb' if packed else '.hack')
+    self.sym_table = copy.copy(SYM_TABLE_DEFAULT)
+
+  def EncodeRecord(self, word):
+    if self.packed:
+      return struct.pack('<H', word)
+    return (FormatWord(word) + '\n').encode()
+
+  def Parse(self):
+    line_num = 0
+    # symbol -> instruction numbers waiting for its value, in order of
+    # first appearance
+    pending = {}
+    header_size = PACKED_HEADER.size if self.packed else 0
+    with open(self.infile, 'r') as fin, open(self.outfile, 'wb+') as fout:
+      fout.write(b'\0' * header_size)
+      for line in fin:
+        kind, value = ParseLine(line)
+        if kind == LINE_EMPTY:
+          continue
+        # Labels resolve every later reference immediately
+        if kind == LINE_LABEL:
+          self.sym_table[value] = line_num
+          continue
+        if kind == LINE_SYMBOL:
+          sym = value
+          value = self.sym_table.get(sym, None)
+          if value == None:
+            pending.setdefault(sym, []).append(line_num)
+            value = 0
+        fout.write(self.EncodeRecord(value))
+        line_num += 1
+      # Backpatch forward references. Whatever is still undefined is a
+      # variable, allocated in order of first appearance.
+      mem_avail = 16
+      for sym, positions in pending.items():
+        value = self.sym_table.get(sym, None)
+        if value == None:
+          value = mem_avail
+          self.sym_table[sym] = mem_avail
+          mem_avail += 1
+        record = self.EncodeRecord(value)
+        for position in positions:
+          fout.seek(header_size + position * len(record))
+          fout.write(record)
+      if self.packed:
+        symtab = PackSymbols(UserSymbols(self.sym_table))
+        fout.seek(0, 2)
+        symtab_offset = fout.tell() if symtab else 0
+        fout.write(symtab)
+        fout.seek(0)
+        fout.write(PACKED_HEADER.pack(PACKED_MAGIC, line_num, symtab_offset))
+
+
+# Label table shared by the chunk workers, set once per worker process
+CHUNK_SYM_TABLE = None
+
+
+def InitChunkWorker(sym_table):
+  global CHUNK_SYM_TABLE
+  CHUNK_SYM_TABLE = sym_table
+
+
+def EncodeLines(lines, sym_table):
+  # Symbols missing from sym_table are left as zero and reported back with
+  # their word index, in order of appearance.
+  words = array.array('H')
+  unresolved = []
+  for line in lines:
+    kind, value = ParseLine(line)
+    if kind == LINE_WORD:
+      words.append(value)
+    elif kind == LINE_SYMBOL:
+      address = sym_table.get(value, None)
+      if address == None:
+        unresolved.append((len(words), value))
+        address = 0
+      words.append(address)
+  return words, unresolved
+
+
+def AssembleChunk(lines):
+  return EncodeLines(lines, CHUNK_SYM_TABLE)
+
+
+class ParallelAssembler(Assembler):
+  # Splits the source at line boundaries and encodes the chunks in worker
+  # processes against the label table from a cheap pre-scan. Variables are
+  # allocated while merging, in chunk order, so the output is identical to
+  # the serial assembler.
+  CHUNKS_PER_WORKER = 4
+  MIN_CHUNK_LINES = 10000
+
+  def __init__(self, infile, packed=False, workers=None):
+    Assembler.__init__(self, infile, packed)
+    self.workers = workers or multiprocessing.cpu_count()
+
+  def FirstPass(self):
+    line_num = 0
+    for line in self.lines:
+      line = line.strip()
+      if not line or line.startswith('//'):
+        continue
+      if line.startswith('('):
+        self.sym_table[ParseLine(line)[1]] = line_num
+      else:
+        line_num += 1
+
+  def SplitLines(self):
+    num_chunks = min(self.workers * self.CHUNKS_PER_WORKER,
+                     len(self.lines) // self.MIN_CHUNK_LINES)
+    num_chunks = max(num_chunks, 1)
+    chunk_size = (len(self.lines) + num_chunks - 1) // num_chunks
+    return [self.lines[i:i+chunk_size]
+            for i in range(0, len(self.lines), chunk_size)]
+
+  def SecondPass(self):
+    chunks = self.SplitLines()
+    if len(chunks) == 1 or self.workers == 1:
+      InitChunkWorker(self.sym_table)
+      results = [AssembleChunk(chunk) for chunk in chunks]
+    else:
+      pool = multiprocessing.Pool(self.workers, InitChunkWorker,
+                                  (self.sym_table,))
+      try:
+        results = pool.map(AssembleChunk, chunks)
+      finally:
+        pool.close()
+        pool.join()
+    mem_avail = 16
+    self.instructions = array.array('H')
+    for words, unresolved in results:
+      for index, sym in unresolved:
+        address = self.sym_table.get(sym, None)
+        if address == None:  # first time appear
+          address = mem_avail
+          self.sym_table[sym] = mem_avail
+          mem_avail += 1
+        words[index] = address
+      self.instructions.extend(words)
+
+
+class IncrementalAssembler(Assembler):
+  # Splits the source into label-delimited sections and caches the encoded
+  # words of each section by the hash of its text, with symbol references
+  # left as relocations. Only sections whose text changed are encoded
+  # again; the rest just get their label and variable addresses patched.
+  CACHE_DIR = '.asmcache'
+
+  def __init__(self, infile, packed=False, cache_dir=None):
+    Assembler.__init__(self, infile, packed)
+    if cache_dir == None:
+      cache_dir = os.path.join(os.path.dirname(self.infile), self.CACHE_DIR)
+    self.cache_dir = cache_dir
+    self.cache_file = os.path.join(
+        cache_dir, os.path.basename(self.infile)[:-4] + '.pickle')
+    self.reused = 0
+    self.encoded = 0
+
+  def SplitSections(self):
+    sections = []
+    labels = []
+    lines = []
+    for line in self.lines:
+      if line.lstrip().startswith('('):
+        if lines:
+          sections.append((labels, lines))
+          labels = []
+          lines = []
+        labels.append(ParseLine(line)[1])
+      else:
+        lines.append(line)
+    sections.append((labels, lines))
+    return sections
+
+  def LoadCache(self):
+    try:
+      with open(self.cache_file, 'rb') as f:
+        return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+      return {}
+
+  def SaveCache(self, cache):
+    if not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    tmpfile = self.cache_file + '.tmp'
+    with open(tmpfile, 'wb') as f:
+      pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpfile, self.cache_file)
+
+  def FirstPass(self):
+    old_cache = self.LoadCache()
+    self.cache = {}
+    self.sections = []
+    line_num = 0
+    for labels, lines in self.SplitSections():
+      for label in labels:
+        self.sym_table[label] = line_num
+      key = hashlib.sha1('\n'.join(lines).encode()).hexdigest()
+      entry = self.cache.get(key, None) or old_cache.get(key, None)
+      if entry == None:
+        entry = EncodeLines(lines, SYM_TABLE_DEFAULT)
+        self.encoded += 1
+      else:
+        self.reused += 1
+      self.cache[key] = entry
+      self.sections.append(entry)
+      line_num += len(entry[0])
+
+  def SecondPass(self):
+    mem_avail = 16
+    self.instructions = array.array('H')
+    for words, unresolved in self.sections:
+      if unresolved:
+        words = array.array('H', words)
+        for index, sym in unresolved:
+          address = self.sym_table.get(sym, None)
+          if address == None:  # first time appear
+            address = mem_avail
+            self.sym_table[sym] = mem_avail
+            mem_avail += 1
+          words[index] = address
+      self.instructions.extend(words)
+    self.SaveCache(self.cache)
+
+
 def main():
-  if len(sys.argv) > 1:
-    infile = sys.argv[1]
+  args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+  flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+  if args:
+    infile = args[0]
   else:
-    print('Usage: %s inputfile'%sys.argv[0])
+    print('Usage: %s [--stream | --jobs=N | --incremental] [--packed] '
+          'inputfile'%sys.argv[0])
     sys.exit(1)
-  assembler = Assembler(infile)
+  packed = '--packed' in flags
+  jobs = [flag for flag in flags if flag.startswith('--jobs')]
+  if '--stream' in flags:
+    assembler = StreamingAssembler(infile, packed)
+  elif '--incremental' in flags:
+    assembler = IncrementalAssembler(infile, packed)
+  elif jobs:
+    workers = int(jobs[-1].split('=')[1]) if '=' in jobs[-1] else None
+    assembler = ParallelAssembler(infile, packed, workers)
+  else:
+    assembler = Assembler(infile, packed)
   assembler.Parse()
 
 if __name__ == '__main__':
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+import array
+import sys
+
+import assembler
+
+RAM_SIZE = 1 << 15
+ADDRESS_MASK = RAM_SIZE - 1
+WORD_MASK = 0xFFFF
+
+# ALU functions by the a-bit and c1..c6 bits of a C instruction. x is D,
+# y is A or M depending on the a-bit.
+COMP_FUNCS = {
+    0b0101010: lambda x, y: 0,
+    0b0111111: lambda x, y: 1,
+    0b0111010: lambda x, y: WORD_MASK,
+    0b0001100: lambda x, y: x,
+    0b0110000: lambda x, y: y,
+    0b0001101: lambda x, y: x ^ WORD_MASK,
+    0b0110001: lambda x, y: y ^ WORD_MASK,
+    0b0001111: lambda x, y: -x & WORD_MASK,
+    0b0110011: lambda x, y: -y & WORD_MASK,
+    0b0011111: lambda x, y: (x + 1) & WORD_MASK,
+    0b0110111: lambda x, y: (y + 1) & WORD_MASK,
+    0b0001110: lambda x, y: (x - 1) & WORD_MASK,
+    0b0110010: lambda x, y: (y - 1) & WORD_MASK,
+    0b0000010: lambda x, y: (x + y) & WORD_MASK,
+    0b0010011: lambda x, y: (x - y) & WORD_MASK,
+    0b0000111: lambda x, y: (y - x) & WORD_MASK,
+    0b0000000: lambda x, y: x & y,
+    0b0010101: lambda x, y: x | y,
+}
+for code, func in list(COMP_FUNCS.items()):
+  COMP_FUNCS[code | 0b1000000] = func
+
+# The same functions as Python expressions, for the block compiler
+COMP_EXPRS = {
+    0b0101010: '0',
+    0b0111111: '1',
+    0b0111010: '65535',
+    0b0001100: '{x}',
+    0b0110000: '{y}',
+    0b0001101: '{x} ^ 65535',
+    0b0110001: '{y} ^ 65535',
+    0b0001111: '-{x} & 65535',
+    0b0110011: '-{y} & 65535',
+    0b0011111: '({x} + 1) & 65535',
+    0b0110111: '({y} + 1) & 65535',
+    0b0001110: '({x} - 1) & 65535',
+    0b0110010: '({y} - 1) & 65535',
+    0b0000010: '({x} + {y}) & 65535',
+    0b0010011: '({x} - {y}) & 65535',
+    0b0000111: '({y} - {x}) & 65535',
+    0b0000000: '{x} & {y}',
+    0b0010101: '{x} | {y}',
+}
+for code, expr in list(COMP_EXPRS.items()):
+  COMP_EXPRS[code | 0b1000000] = expr
+
+JUMP_EXPRS = [None, '0 < {t} < 32768', '{t} == 0', '{t} < 32768',
+              '{t} >= 32768', '{t} != 0', '{t} == 0 or {t} >= 32768', 'True']
+
+# Jump bits -> whether the jump is taken for a zero, positive and negative
+# ALU output
+JUMP_CONDITIONS = [(j & 2 != 0, j & 1 != 0, j & 4 != 0) for j in range(8)]
+
+# Decoded form of '@X / 0;JMP' jumping to itself, the usual end of program
+HALT = ('halt',)
+
+
+def ToSigned(value):
+  return value - 0x10000 if value & 0x8000 else value
+
+
+def LoadRom(infile):
+  if infile.endswith('.hackb'):
+    return assembler.ReadPacked(infile)
+  with open(infile, 'r') as f:
+    words = [int(line, 2) for line in f.read().split()]
+  return array.array('H', words), {}
+
+
+class HackEmulator(object):
+  def __init__(self, words, symbols=None):
+    self.rom = array.array('H', words)
+    self.symbols = dict(assembler.SYM_TABLE_DEFAULT)
+    if symbols:
+      self.symbols.update(symbols)
+    self.program = [self.Decode(pc) for pc in range(len(self.rom))]
+    self.Reset()
+
+  def Decode(self, pc):
+    word = self.rom[pc]
+    if not word & 0x8000:
+      return word
+    comp = COMP_FUNCS[(word >> 6) & 0x7F]
+    use_m = bool(word & 0x1000)
+    dest = (word >> 3) & 7
+    jump = word & 7
+    if (jump == 7 and not dest and pc > 0 and self.rom[pc-1] == pc - 1):
+      return HALT
+    return (comp, use_m, dest, JUMP_CONDITIONS[jump] if jump else None)
+
+  def Reset(self):
+    self.ram = array.array('H', bytes(2 * RAM_SIZE))
+    self.a = 0
+    self.d = 0
+    self.pc = 0
+    self.cycles = 0
+    self.halted = False
+    self.counts = None  # executions per ROM address, when profiling
+
+  def Address(self, address):
+    if isinstance(address, str):
+      address = self.symbols[address]
+    return address & ADDRESS_MASK
+
+  def Peek(self, address, offset=0):
+    return ToSigned(self.ram[self.Address(address) + offset])
+
+  def Poke(self, address, value, offset=0):
+    self.ram[self.Address(address) + offset] = value & WORD_MASK
+
+  def Screen(self):
+    return self.ram[self.symbols['SCREEN']:self.symbols['KBD']]
+
+  def Jump(self, pc, count):
+    # Called when profiling, after a jump to pc once count cycles of the
+    # current run have been executed
+    pass
+
+  def Run(self, cycles=None):
+    # Runs until the program halts or the given number of cycles has been
+    # executed, and returns the number of cycles executed. With counts set
+    # it also counts executions per instruction and calls Jump.
+    program = self.program
+    ram = self.ram
+    counts = self.counts
+    profiling = counts != None
+    size = len(program)
+    a = self.a
+    d = self.d
+    pc = self.pc
+    limit = cycles if cycles != None else -1
+    count = 0
+    while count != limit and pc < size:
+      ins = program[pc]
+      count += 1
+      if profiling:
+        counts[pc] += 1
+      if ins.__class__ is int:
+        a = ins
+        pc += 1
+        continue
+      if ins is HALT:
+        if a == pc - 1:
+          count -= 1
+          if profiling:
+            counts[pc] -= 1
+          self.halted = True
+          break
+        pc = a
+        if profiling:
+          self.Jump(pc, count)
+        continue
+      comp, use_m, dest, jump = ins
+      out = comp(d, ram[a & ADDRESS_MASK] if use_m else a)
+      if jump and jump[2 if out & 0x8000 else (1 if out else 0)]:
+        pc = a
+      else:
+        pc += 1
+        jump = None
+      if dest:
+        if dest & 1:
+          ram[a & ADDRESS_MASK] = out
+        if dest & 2:
+          d = out
+        if dest & 4:
+          a = out
+      if jump and profiling:
+        self.Jump(pc, count)
+    if pc >= size:
+      self.halted = True
+    self.a = a
+    self.d = d
+    self.pc = pc
+    self.cycles += count
+    return count
+
+  def Step(self):
+    return self.Run(1)
+
+
+class BlockEmulator(HackEmulator):
+  # Translates each basic block of the ROM into one Python function on first
+  # execution and caches it by start address. A block runs up to and
+  # including the first jump instruction. Cycle counts stay exact: the
+  # last partial block of a bounded run and halt loops go through the
+  # instruction interpreter.
+  MAX_BLOCK = 1024
+
+  def Reset(self):
+    HackEmulator.Reset(self)
+    if not hasattr(self, 'blocks'):
+      self.blocks = {}
+
+  def CompileBlock(self, start):
+    program = self.program
+    if program[start] is HALT:
+      return None, 1
+    lines = []
+    a_value = None  # A as a constant, or None once it is computed
+    pc = start
+    end = None
+    while pc < len(program) and pc - start < self.MAX_BLOCK:
+      ins = program[pc]
+      if ins is HALT:
+        break
+      word = self.rom[pc]
+      pc += 1
+      if ins.__class__ is int:
+        a_value = ins
+        continue
+      a_expr = 'a' if a_value == None else str(a_value)
+      m_expr = 'ram[a & 32767]' if a_value == None else 'ram[%d]'%a_value
+      comp = (word >> 6) & 0x7F
+      dest = (word >> 3) & 7
+      jump = word & 7
+      expr = COMP_EXPRS[comp].format(x='d', y=m_expr if word & 0x1000
+                                     else a_expr)
+      if a_value == None and (dest & 4 or jump):
+        # the jump target and M address are the A before this instruction
+        lines.append('t = a')
+        a_expr = 't'
+        m_expr = 'ram[t & 32767]'
+      if jump or dest not in (0, 1, 2, 4):
+        lines.append('o = ' + expr)
+        expr = 'o'
+      if dest & 1:
+        lines.append('%s = %s'%(m_expr, expr))
+      if dest & 2:
+        lines.append('d = ' + expr)
+      if dest & 4:
+        lines.append('a = ' + expr)
+        a_value = None
+      if jump:
+        end = (JUMP_EXPRS[jump].format(t='o'), a_expr)
+        break
+    final_a = 'a' if a_value == None else str(a_value)
+    if end == None:
+      lines.append('return %s, d, %d'%(final_a, pc))
+    elif end[0] == 'True':
+      lines.append('return %s, d, %s'%(final_a, end[1]))
+    else:
+      lines.append('if %s:'%end[0])
+      lines.append('  return %s, d, %s'%(final_a, end[1]))
+      lines.append('return %s, d, %d'%(final_a, pc))
+    source = 'def block(ram, a, d):\n' + ''.join('  %s\n'%line for line in lines)
+    namespace = {}
+    exec(compile(source, '<block %d>'%start, 'exec'), namespace)
+    return namespace['block'], pc - start
+
+  def Run(self, cycles=None):
+    blocks = self.blocks
+    size = len(self.program)
+    ram = self.ram
+    a = self.a
+    d = self.d
+    pc = self.pc
+    count = 0
+    while pc < size and (cycles == None or count < cycles):
+      block = blocks.get(pc, None)
+      if block == None:
+        block = blocks[pc] = self.CompileBlock(pc)
+      func, length = block
+      if func == None or (cycles != None and count + length > cycles):
+        self.a = a
+        self.d = d
+        self.pc = pc
+        executed = HackEmulator.Run(self, 1 if func == None
+                                    else cycles - count)
+        self.cycles -= executed
+        count += executed
+        a = self.a
+        d = self.d
+        pc = self.pc
+        if self.halted or func != None:
+          break
+        continue
+      a, d, pc = func(ram, a, d)
+      count += length
+    if pc >= size:
+      self.halted = True
+    self.a = a
+    self.d = d
+    self.pc = pc
+    self.cycles += count
+    return count
+
+
+def main():
+  args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+  flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+  if not args:
+    print('Usage: %s [--cycles=N] [--blocks] inputfile [address ...]'
+          %sys.argv[0])
+    sys.exit(1)
+  cycles = None
+  for flag in flags:
+    if flag.startswith('--cycles='):
+      cycles = int(flag.split('=')[1])
+  words, symbols = LoadRom(args[0])
+  if '--blocks' in flags:
+    emulator = BlockEmulator(words, symbols)
+  else:
+    emulator = HackEmulator(words, symbols)
+  emulator.Run(cycles)
+  print('%d cycles%s'%(emulator.cycles,
+                       ', halted' if emulator.halted else ''))
+  for address in args[1:]:
+    if address.isdigit():
+      address = int(address)
+    print('%s: %d'%(address, emulator.Peek(address)))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import array
+import struct
+import sys
+
+import assembler
+
+# Relocatable object: header, the little-endian 16-bit words assembled as if
+# the object started at ROM address 0, the 32-bit indices of the words
+# holding ROM addresses, then the symbols as text lines. 'E name offset'
+# exports a label, 'I name index' is a symbol the word at index uses but
+# the object does not define: a label of another object or a variable.
+OBJECT_HEADER = struct.Struct('<4sII')
+OBJECT_MAGIC = b'HOBJ'
+
+
+class HackObject(object):
+  def __init__(self, words=None, relocations=None, exports=None,
+               imports=None):
+    self.words = array.array('H', words or [])
+    self.relocations = array.array('I', relocations or [])
+    self.exports = exports or {}
+    self.imports = imports or []  # [(index, symbol)] in index order
+
+
+class ObjectBuilder(object):
+  # Assembles a HackObject from the instructions a CodeWriter emits, each
+  # encoded from its fields as it arrives, with labels kept as fixups
+  # until Finish. listing, an object taking the same calls (e.g.
+  # VMtranslator.AsmOutput), also receives them as assembly text.
+  def __init__(self, listing=None):
+    self.obj = HackObject()
+    self.listing = listing
+    self.symbols = []
+    self.line_words = array.array('I')  # line number -> word index
+
+  def writeA(self, value):
+    if self.listing:
+      self.listing.writeA(value)
+    words = self.obj.words
+    self.line_words.append(len(words))
+    if value.__class__ is not int:
+      self.symbols.append((len(words), value))
+      value = 0
+    words.append(value)
+
+  def writeC(self, dest, comp, jump):
+    if self.listing:
+      self.listing.writeC(dest, comp, jump)
+    words = self.obj.words
+    self.line_words.append(len(words))
+    words.append(assembler.C_PREFIX | assembler.CMD_CODES[comp]
+                 | assembler.DEST_CODES[dest] | assembler.JUMP_CODES[jump])
+
+  def writeLabel(self, label):
+    if self.listing:
+      self.listing.writeLabel(label)
+    self.line_words.append(len(self.obj.words))
+    self.obj.exports[label] = len(self.obj.words)
+
+  def writeComment(self, comment):
+    if self.listing:
+      self.listing.writeComment(comment)
+    self.line_words.append(len(self.obj.words))
+
+  def close(self):
+    if self.listing:
+      self.listing.close()
+
+  def AddLine(self, line):
+    words = self.obj.words
+    self.line_words.append(len(words))
+    kind, value = assembler.ParseLine(line)
+    if kind == assembler.LINE_EMPTY:
+      return
+    if kind == assembler.LINE_LABEL:
+      self.obj.exports[value] = len(words)
+      return
+    if kind == assembler.LINE_SYMBOL:
+      self.symbols.append((len(words), value))
+      value = 0
+    words.append(value)
+
+  def Finish(self, relocation_lines=()):
+    # relocation_lines are the indices of the lines whose '@number' is a
+    # ROM address, as CodeWriter.writeAddress records them
+    obj = self.obj
+    relocations = [self.line_words[line_num] for line_num in relocation_lines]
+    for index, sym in self.symbols:
+      if sym in obj.exports:
+        obj.words[index] = obj.exports[sym]
+        relocations.append(index)
+      elif sym in assembler.SYM_TABLE_DEFAULT:
+        obj.words[index] = assembler.SYM_TABLE_DEFAULT[sym]
+      else:
+        obj.imports.append((index, sym))
+    obj.relocations.extend(sorted(relocations))
+    return obj
+
+
+def AssembleObject(lines, relocation_lines=()):
+  builder = ObjectBuilder()
+  for line in lines:
+    builder.AddLine(line)
+  return builder.Finish(relocation_lines)
+
+
+def WriteObject(outfile, obj):
+  words = array.array('H', obj.words)
+  relocations = array.array('I', obj.relocations)
+  if sys.byteorder == 'big':
+    words.byteswap()
+    relocations.byteswap()
+  symtab = ''.join(['E %s %d\n'%(sym, offset)
+                    for sym, offset in obj.exports.items()]
+                   + ['I %s %d\n'%(sym, index)
+                      for index, sym in obj.imports]).encode()
+  with open(outfile, 'wb') as f:
+    f.write(OBJECT_HEADER.pack(OBJECT_MAGIC, len(words), len(relocations))
+            + words.tobytes() + relocations.tobytes() + symtab)
+
+
+def ReadObject(infile):
+  with open(infile, 'rb') as f:
+    data = f.read()
+  magic, count, relocation_count = OBJECT_HEADER.unpack_from(data)
+  assert magic == OBJECT_MAGIC
+  offset = OBJECT_HEADER.size
+  obj = HackObject()
+  obj.words.frombytes(data[offset:offset+2*count])
+  offset += 2 * count
+  size = obj.relocations.itemsize * relocation_count
+  obj.relocations.frombytes(data[offset:offset+size])
+  if sys.byteorder == 'big':
+    obj.words.byteswap()
+    obj.relocations.byteswap()
+  for line in data[offset+size:].decode().splitlines():
+    kind, sym, value = line.split()
+    if kind == 'E':
+      obj.exports[sym] = int(value)
+    else:
+      obj.imports.append((int(value), sym))
+  return obj
+
+
+def Link(objects):
+  # Places the objects one after another and returns the ROM words and the
+  # user symbols. Variables get RAM addresses from 16 in the order the
+  # objects use them, like the assembler does for one source file.
+  symbols = {}
+  bases = []
+  size = 0
+  for obj in objects:
+    bases.append(size)
+    for sym, offset in obj.exports.items():
+      if sym in symbols:
+        raise ValueError('Symbol defined twice: ' + sym)
+      symbols[sym] = size + offset
+    size += len(obj.words)
+  mem_avail = 16
+  words = array.array('H')
+  for obj, base in zip(objects, bases):
+    obj_words = array.array('H', obj.words)
+    for index in obj.relocations:
+      obj_words[index] += base
+    for index, sym in obj.imports:
+      address = symbols.get(sym, None)
+      if address == None:  # first time appear
+        address = mem_avail
+        symbols[sym] = mem_avail
+        mem_avail += 1
+      obj_words[index] = address
+    words.extend(obj_words)
+  return words, symbols
+
+
+def WriteRom(outfile, words, symbols=None, packed=False):
+  if packed:
+    assembler.WritePacked(outfile, words, symbols)
+    return
+  with open(outfile, 'w') as f:
+    f.write(''.join([assembler.FormatWord(word) + '\n' for word in words]))
+
+
+def LoadObject(infile):
+  # .hacko objects, or .asm files that only use labels for ROM addresses
+  if infile.endswith('.hacko'):
+    return ReadObject(infile)
+  with open(infile, 'r') as f:
+    return AssembleObject(f.read().split('\n'))
+
+
+def main():
+  args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+  flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+  if '--object' in flags and args:
+    for infile in args:
+      WriteObject(infile[:-4] + '.hacko', LoadObject(infile))
+    return
+  if len(args) < 2:
+    print('Usage: %s [--packed] outputfile inputfile.hacko|.asm ...\n'
+          '       %s --object inputfile.asm ...'%(sys.argv[0], sys.argv[0]))
+    sys.exit(1)
+  words, symbols = Link([LoadObject(infile) for infile in args[1:]])
+  WriteRom(args[0], words, symbols, '--packed' in flags)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+import sys
+
+PUSH_D = ['@SP', 'A=M', 'M=D', '@SP', 'M=M+1']
+POP_D = ['@SP', 'M=M-1', 'A=M', 'D=M']
+ROM_LABEL = '__ROM.'
+
+
+def IsLabel(ins):
+  return ins.startswith('(')
+
+
+def IsAddress(ins):
+  return ins.startswith('@')
+
+
+def SplitC(ins):
+  dest = ''
+  jump = ''
+  ind_dest = ins.find('=')
+  if ind_dest != -1:
+    dest = ins[:ind_dest]
+    ins = ins[ind_dest+1:]
+  ind_jump = ins.find(';')
+  if ind_jump != -1:
+    jump = ins[ind_jump+1:]
+    ins = ins[:ind_jump]
+  return dest, ins, jump
+
+
+def IsJump(ins):
+  return not IsLabel(ins) and not IsAddress(ins) and ';' in ins
+
+
+def NextIsAddress(code, i):
+  # Whether the instruction after code[:i] overwrites A before using it
+  return i < len(code) and IsAddress(code[i])
+
+
+def ReadCode(lines):
+  code = []
+  for line in lines:
+    ind_comment = line.find('//')
+    if ind_comment != -1:
+      line = line[:ind_comment]
+    line = ''.join(line.split())
+    if line:
+      code.append(line)
+  return code
+
+
+def LabelAbsoluteJumps(code):
+  # '@N' right before a jump is a ROM address, which moves as soon as any
+  # instruction is removed. Turn those into labels for the duration of the
+  # optimization. Returns None when an address is also used as RAM address
+  # by the jump instruction itself.
+  targets = set()
+  rom = 0
+  for i, ins in enumerate(code):
+    if IsLabel(ins):
+      continue
+    if (IsAddress(ins) and ins[1:].isdigit() and i+1 < len(code)
+        and IsJump(code[i+1])):
+      dest, comp, jump = SplitC(code[i+1])
+      if 'M' in dest or 'M' in comp:
+        return None
+      targets.add(int(ins[1:]))
+    rom += 1
+  if not targets:
+    return code
+  labeled = []
+  rom = 0
+  for i, ins in enumerate(code):
+    if IsLabel(ins):
+      labeled.append(ins)
+      continue
+    if rom in targets:
+      labeled.append('(' + ROM_LABEL + str(rom) + ')')
+    if (IsAddress(ins) and ins[1:].isdigit() and i+1 < len(code)
+        and IsJump(code[i+1])):
+      ins = '@' + ROM_LABEL + ins[1:]
+    labeled.append(ins)
+    rom += 1
+  if rom in targets:
+    labeled.append('(' + ROM_LABEL + str(rom) + ')')
+  return labeled
+
+
+def ResolveAbsoluteJumps(code):
+  addresses = {}
+  rom = 0
+  for ins in code:
+    if IsLabel(ins):
+      if ins.startswith('(' + ROM_LABEL):
+        addresses[ins[1:-1]] = rom
+    else:
+      rom += 1
+  resolved = []
+  for ins in code:
+    if ins.startswith('(' + ROM_LABEL):
+      continue
+    if ins.startswith('@' + ROM_LABEL):
+      ins = '@' + str(addresses[ins[1:]])
+    resolved.append(ins)
+  return resolved
+
+
+def RemovePushPop(code):
+  # pushD() followed by popD() leaves D and SP unchanged. The only other
+  # effect is the store above the stack top, which is dead in VM code.
+  out = []
+  hits = 0
+  i = 0
+  pattern = PUSH_D + POP_D
+  while i < len(code):
+    if code[i:i+len(pattern)] == pattern:
+      i += len(pattern)
+      if not NextIsAddress(code, i):
+        out.extend(['@SP', 'A=M', 'M=D'])
+      hits += 1
+      continue
+    out.append(code[i])
+    i += 1
+  return out, hits
+
+
+def RemovePopPush(code):
+  # popD() followed by pushD() only reads the stack top into D; pushD()
+  # leaves A at SP, which later code may rely on
+  out = []
+  hits = 0
+  i = 0
+  pattern = POP_D + PUSH_D
+  while i < len(code):
+    if code[i:i+len(pattern)] == pattern:
+      i += len(pattern)
+      out.extend(['@SP', 'A=M-1', 'D=M'])
+      if not NextIsAddress(code, i):
+        out.append('@SP')
+      hits += 1
+      continue
+    out.append(code[i])
+    i += 1
+  return out, hits
+
+
+def RemoveIncDec(code):
+  out = []
+  hits = 0
+  i = 0
+  pattern = ['@SP', 'M=M+1', '@SP', 'M=M-1']
+  while i < len(code):
+    if code[i:i+len(pattern)] == pattern and NextIsAddress(code, i+4):
+      i += len(pattern)
+      hits += 1
+      continue
+    out.append(code[i])
+    i += 1
+  return out, hits
+
+
+def RemoveJumpToNext(code):
+  out = []
+  hits = 0
+  i = 0
+  while i < len(code):
+    if IsAddress(code[i]) and i+1 < len(code) and code[i+1] == '0;JMP':
+      j = i + 2
+      labels = []
+      while j < len(code) and IsLabel(code[j]):
+        labels.append(code[j][1:-1])
+        j += 1
+      if code[i][1:] in labels:
+        i += 2
+        hits += 1
+        continue
+    out.append(code[i])
+    i += 1
+  return out, hits
+
+
+def RemoveDeadAddress(code):
+  out = []
+  hits = 0
+  for i, ins in enumerate(code):
+    if IsAddress(ins) and NextIsAddress(code, i+1):
+      hits += 1
+      continue
+    out.append(ins)
+  return out, hits
+
+
+def RemoveRedundantAddress(code):
+  # '@X' while A already holds X
+  out = []
+  hits = 0
+  a_value = None
+  for ins in code:
+    if IsLabel(ins):
+      a_value = None
+    elif IsAddress(ins):
+      if ins[1:] == a_value:
+        hits += 1
+        continue
+      a_value = ins[1:]
+    else:
+      dest, comp, jump = SplitC(ins)
+      if 'A' in dest or jump:
+        a_value = None
+    out.append(ins)
+  return out, hits
+
+
+def RemoveRedundantLoad(code):
+  # 'D=M' or 'M=D' while D already equals M
+  out = []
+  hits = 0
+  d_is_m = False
+  for ins in code:
+    if IsLabel(ins) or IsAddress(ins):
+      d_is_m = False
+    else:
+      dest, comp, jump = SplitC(ins)
+      if (ins == 'D=M' or ins == 'M=D') and d_is_m:
+        hits += 1
+        continue
+      if jump or 'A' in dest:
+        d_is_m = False
+      elif ins == 'D=M' or ins == 'M=D' or ('D' in dest and 'M' in dest):
+        d_is_m = True
+      elif 'D' in dest or 'M' in dest:
+        d_is_m = False
+    out.append(ins)
+  return out, hits
+
+
+# Applied in order until none of them matches any more
+RULES = [('push-pop', RemovePushPop),
+         ('pop-push', RemovePopPush),
+         ('sp-inc-dec', RemoveIncDec),
+         ('jump-to-next', RemoveJumpToNext),
+         ('dead-address', RemoveDeadAddress),
+         ('redundant-address', RemoveRedundantAddress),
+         ('redundant-load', RemoveRedundantLoad)]
+
+
+def Optimize(lines, rules=RULES):
+  hits = dict((name, 0) for name, _ in rules)
+  code = LabelAbsoluteJumps(ReadCode(lines))
+  if code == None:
+    return ReadCode(lines), hits
+  changed = True
+  while changed:
+    changed = False
+    for name, rule in rules:
+      code, count = rule(code)
+      if count:
+        hits[name] += count
+        changed = True
+  return ResolveAbsoluteJumps(code), hits
+
+
+def main():
+  if len(sys.argv) < 2:
+    print('Usage: %s inputfile [outputfile]'%sys.argv[0])
+    sys.exit(1)
+  infile = sys.argv[1]
+  outfile = sys.argv[2] if len(sys.argv) > 2 else infile
+  with open(infile, 'r') as f:
+    lines = f.read().split('\n')
+  before = len([ins for ins in ReadCode(lines) if not IsLabel(ins)])
+  code, hits = Optimize(lines)
+  after = len([ins for ins in code if not IsLabel(ins)])
+  with open(outfile, 'w') as f:
+    f.write('\n'.join(code) + '\n')
+  for name, _ in RULES:
+    print('%-20s %d'%(name, hits[name]))
+  print('%d -> %d instructions'%(before, after))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import array
+import bisect
+import sys
+
+import assembler
+import emulator
+from emulator import ADDRESS_MASK
+
+ROOT = '[bootstrap]'
+
+
+def IsFunctionLabel(label):
+  # Labels written by CodeWriter.writeFunction; labels inside a function
+  # are 'function$label' and shared routines start with '__'.
+  return '$' not in label and not label.startswith('__')
+
+
+def AssembleWithLabels(infile):
+  asm = assembler.Assembler(infile)
+  asm.FirstPass()
+  labels = assembler.UserSymbols(asm.sym_table)
+  asm.SecondPass()
+  return asm.instructions, labels
+
+
+class HackProfiler(emulator.HackEmulator):
+  # Attributes every executed instruction to the VM function on top of a
+  # shadow call stack. A frame is pushed when execution reaches a function
+  # label, with the return address and ARG of the frame the call built,
+  # and popped when execution reaches that return address with the stack
+  # back at ARG+1. The emulator's loop keeps the counts and calls Jump.
+  def __init__(self, words, labels):
+    emulator.HackEmulator.__init__(self, words)
+    self.labels = sorted((address, label) for label, address
+                         in labels.items())
+    self.entries = {}
+    for address, label in self.labels:
+      if IsFunctionLabel(label):
+        self.entries[address] = label
+
+  def Reset(self):
+    emulator.HackEmulator.Reset(self)
+    self.counts = array.array('L', [0]) * len(self.rom)
+    self.calls = {}
+    self.stacks = {}
+    self.frames = [(ROOT, None, None)]
+    self.path = (ROOT,)
+
+  def Enter(self, pc, count):
+    ram = self.ram
+    name = self.entries[pc]
+    lcl = ram[1]
+    self.Account(count)
+    self.frames.append((name, ram[(lcl - 5) & ADDRESS_MASK], ram[2]))
+    self.path = self.path + (name,)
+    self.calls[name] = self.calls.get(name, 0) + 1
+
+  def Leave(self, pc, count):
+    frames = self.frames
+    sp = self.ram[0]
+    if not (len(frames) > 1 and frames[-1][1] == pc):
+      return
+    self.Account(count)
+    while (len(frames) > 1 and frames[-1][1] == pc
+           and frames[-1][2] >= sp - 1):
+      frames.pop()
+    self.path = tuple(frame[0] for frame in frames)
+
+  def Account(self, count):
+    cycles = self.cycles + count - self.path_start
+    if cycles:
+      self.stacks[self.path] = self.stacks.get(self.path, 0) + cycles
+    self.path_start = self.cycles + count
+
+  def Jump(self, pc, count):
+    if pc in self.entries:
+      self.Enter(pc, count)
+    else:
+      self.Leave(pc, count)
+
+  def Run(self, cycles=None):
+    self.path_start = self.cycles
+    if self.cycles == 0 and self.pc in self.entries:
+      self.Enter(self.pc, 0)
+    count = emulator.HackEmulator.Run(self, cycles)
+    self.Account(0)
+    return count
+
+  def FunctionStats(self):
+    # name -> (calls, inclusive cycles, exclusive cycles)
+    inclusive = {}
+    exclusive = {}
+    for path, cycles in self.stacks.items():
+      exclusive[path[-1]] = exclusive.get(path[-1], 0) + cycles
+      for name in set(path):
+        inclusive[name] = inclusive.get(name, 0) + cycles
+    return dict((name, (self.calls.get(name, 0), inclusive[name],
+                        exclusive.get(name, 0))) for name in inclusive)
+
+  def LabelStats(self):
+    # label -> cycles spent between it and the next label
+    stats = {}
+    addresses = [address for address, _ in self.labels]
+    for pc, count in enumerate(self.counts):
+      if not count:
+        continue
+      index = bisect.bisect_right(addresses, pc) - 1
+      label = self.labels[index][1] if index >= 0 else ROOT
+      stats[label] = stats.get(label, 0) + count
+    return stats
+
+  def WriteCollapsed(self, outfile):
+    with open(outfile, 'w') as f:
+      for path, cycles in sorted(self.stacks.items()):
+        f.write('%s %d\n'%(';'.join(path), cycles))
+
+  def Report(self, top=20):
+    lines = ['%d cycles'%self.cycles, '',
+             '%-40s %8s %12s %12s'%('function', 'calls', 'inclusive',
+                                    'exclusive')]
+    stats = self.FunctionStats()
+    for name in sorted(stats, key=lambda name: -stats[name][2]):
+      calls, inclusive, exclusive = stats[name]
+      lines.append('%-40s %8d %12d %12d'%(name, calls, inclusive, exclusive))
+    lines.extend(['', '%-40s %12s'%('label', 'cycles')])
+    label_stats = self.LabelStats()
+    hottest = sorted(label_stats, key=lambda label: -label_stats[label])
+    for label in hottest[:top]:
+      lines.append('%-40s %12d'%(label, label_stats[label]))
+    return '\n'.join(lines)
+
+
+def main():
+  args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+  flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+  if not args:
+    print('Usage: %s [--cycles=N] [--collapsed=outfile] inputfile.asm'
+          %sys.argv[0])
+    sys.exit(1)
+  cycles = None
+  collapsed = None
+  for flag in flags:
+    if flag.startswith('--cycles='):
+      cycles = int(flag.split('=')[1])
+    elif flag.startswith('--collapsed='):
+      collapsed = flag.split('=')[1]
+  words, labels = AssembleWithLabels(args[0])
+  profiler = HackProfiler(words, labels)
+  profiler.Run(cycles)
+  print(profiler.Report())
+  if collapsed:
+    profiler.WriteCollapsed(collapsed)
+
+if __name__ == '__main__':
+  main()
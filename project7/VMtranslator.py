@@ -58,17 +58,81 @@ class Parser(object):
 class CodeWriter(object):
     SEGMENT_TABLE = {'local': 'LCL', 'argument': 'ARG', 'this': 'THIS',
                      'that': 'THAT'}
-    def __init__(self, file):
+    COMPARE_JUMPS = {'eq': 'JEQ', 'lt': 'JLT', 'gt': 'JGT'}
+    def __init__(self, file, compare_policy='speed'):
         self.file = file
         filename = file.name.split('/')[-1]
         self.filebase = '.'.join(filename.split('.')[:-1])
         self.line_count = 0
+        # 'speed' inlines eq/lt/gt, 'size' calls one shared routine per
+        # comparison kind with the return address in R15
+        self.compare_policy = compare_policy
+        self.compare_count = 0
+        self.shared_routines = []
         
     def writeln(self, content):
         self.file.write(content + '\n')
         self.line_count += 1
 
+    def writeLabel(self, label):
+        self.writeln('(' + label + ')')
+        self.line_count -= 1
+
+    def writeCompare(self, cmd):
+        if self.compare_policy == 'size':
+            name = '__' + cmd.upper()
+            if name not in self.shared_routines:
+                self.shared_routines.append(name)
+            self.compare_count += 1
+            label = self.filebase + '$cmp.' + str(self.compare_count)
+            self.writeln('@' + label)
+            self.writeln('D=A')
+            self.writeln('@' + name)
+            self.writeln('0; JMP')
+            self.writeLabel(label)
+        else:
+            self.writeCompareBody(cmd)
+
+    def writeCompareBody(self, cmd, true_label=None):
+        # x = -1, then x = 0 unless the comparison holds
+        self.writeln('@SP')
+        self.writeln('AM=M-1')
+        self.writeln('D=M')
+        self.writeln('A=A-1')
+        self.writeln('D=M-D')
+        self.writeln('M=-1')
+        if true_label:
+            self.writeln('@' + true_label)
+        else:
+            self.writeln('@' + str(self.line_count+5))
+        self.writeln('D; ' + self.COMPARE_JUMPS[cmd])
+        self.writeln('@SP')
+        self.writeln('A=M-1')
+        self.writeln('M=0')
+        if true_label:
+            self.writeLabel(true_label)
+
+    def writeSharedRoutines(self):
+        if not self.shared_routines:
+            return
+        # keep execution from falling into the routines
+        self.writeComments('Shared routines')
+        self.writeLabel('__END')
+        self.writeln('@__END')
+        self.writeln('0; JMP')
+        for name in self.shared_routines:
+            self.writeLabel(name)
+            self.writeln('@R15')
+            self.writeln('M=D')
+            self.writeCompareBody(name[2:].lower(), name + '.TRUE')
+            self.writeln('@R15')
+            self.writeln('A=M')
+            self.writeln('0; JMP')
+
     def writeArithmetic(self, cmd):
+        if cmd in self.COMPARE_JUMPS:
+            self.writeCompare(cmd)
+            return
         if cmd in ['not', 'neg']:
             self.writeln('@SP')
             self.writeln('A=M-1')
@@ -91,23 +155,6 @@ class CodeWriter(object):
             self.writeln('M=D&M')
         elif cmd == 'or':
             self.writeln('M=D|M')
-        elif cmd in ['eq', 'lt', 'gt']:
-            self.writeln('D=M-D')
-            self.writeln('@' + str(self.line_count+7))
-            if cmd == 'eq':
-                self.writeln('D; JEQ')
-            elif cmd == 'lt':
-                self.writeln('D; JLT')
-            else:  # cmd == 'gt'
-                self.writeln('D; JGT')
-            self.writeln('@SP')
-            self.writeln('A=M-1')
-            self.writeln('M=0')
-            self.writeln('@' + str(self.line_count+5))
-            self.writeln('0; JMP')
-            self.writeln('@SP')
-            self.writeln('A=M-1')
-            self.writeln('M=-1')
     
     def writePushPop(self, cmd, segment, index):
         def pushD():
@@ -187,15 +234,21 @@ class CodeWriter(object):
         self.file.close()
 
 def main():
-    if len(sys.argv) < 2:
-        print('Usage: %s filename'%sys.argv[0])
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    if not args:
+        print('Usage: %s [--compare=speed|size] filename'%sys.argv[0])
         sys.exit(1)
-    inputfile = sys.argv[1]
+    compare_policy = 'speed'
+    for flag in flags:
+        if flag.startswith('--compare='):
+            compare_policy = flag.split('=')[1]
+    inputfile = args[0]
     in_f = open(inputfile, 'r')
     parser = Parser(in_f)
     outputfile = '.'.join(inputfile.split('.')[:-1]) + '.asm'
     out_f = open(outputfile, 'w')
-    writer = CodeWriter(out_f)
+    writer = CodeWriter(out_f, compare_policy)
     while parser.hasMoreCommands():
         writer.writeComments(parser.current_command)
         ctype = parser.currentCommandType()
@@ -204,6 +257,7 @@ def main():
         else:
             writer.writePushPop(ctype, parser.arg1(), parser.arg2())
         parser.advance()
+    writer.writeSharedRoutines()
     writer.Close()
     in_f.close()
     
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Runs VM programs without translating them to Hack. All .vm files are
+compiled into one list of (opcode, x, y) tuples with function and label
+targets resolved, then executed on a RAM with the same layout as the Hack
+build: SP, LCL, ARG, THIS, THAT in RAM[0..4], temp at 5, statics from 16
+in order of first use and the stack from 256. The program and RAM are
+plain lists, which CPython indexes faster than arrays.
+"""
+import os
+import sys
+
+from VMtranslator import CType, ListVmFile, Parser
+
+RAM_SIZE = 1 << 15
+WORD_MASK = 0xFFFF
+
+# opcodes
+PUSH_CONSTANT = 0  # x = value
+PUSH_SEGMENT = 1  # x = base pointer address, y = index
+PUSH_ADDRESS = 2  # x = address, for static, temp and pointer
+POP_SEGMENT = 3
+POP_ADDRESS = 4
+ADD = 5
+SUB = 6
+NEG = 7
+EQ = 8
+GT = 9
+LT = 10
+AND = 11
+OR = 12
+NOT = 13
+GOTO = 14  # x = target
+IF_GOTO = 15
+FUNCTION = 16  # x = nlocals
+CALL = 17  # x = target, y = nargs
+RETURN = 18
+HALT = 19  # goto to itself, the usual end of program
+
+ARITHMETIC_OPS = {'add': ADD, 'sub': SUB, 'neg': NEG, 'eq': EQ, 'gt': GT,
+                  'lt': LT, 'and': AND, 'or': OR, 'not': NOT}
+SEGMENT_POINTERS = {'local': 1, 'argument': 2, 'this': 3, 'that': 4}
+
+
+class VMInterpreter(object):
+    def __init__(self, inputfiles):
+        self.code = []
+        self.functions = {}  # name -> code index
+        self.statics = {}  # 'File.index' -> address
+        self.has_sys_init = False
+        self.compile(inputfiles)
+        self.reset()
+
+    def staticAddress(self, filename, index):
+        name = filename + '.' + str(index)
+        if name not in self.statics:
+            self.statics[name] = 16 + len(self.statics)
+        return self.statics[name]
+
+    def compile(self, inputfiles):
+        # labels are resolved once every function is known
+        labels = {}
+        fixups = []  # (code index, label or function name)
+        function_name = 'null'
+        for inputfile in inputfiles:
+            filename = os.path.split(inputfile)[1]
+            filename = '.'.join(filename.split('.')[:-1])
+            if filename == 'Sys':
+                self.has_sys_init = True
+            with open(inputfile, 'r') as in_f:
+                parser = Parser(in_f)
+                while parser.hasMoreCommands():
+                    ctype = parser.currentCommandType()
+                    if ctype == CType.C_LABEL:
+                        labels[function_name + '$' + parser.arg1()] = len(
+                            self.code)
+                    elif ctype in [CType.C_GOTO, CType.C_IF]:
+                        fixups.append((len(self.code),
+                                       function_name + '$' + parser.arg1()))
+                        self.code.append((GOTO if ctype == CType.C_GOTO
+                                          else IF_GOTO, None, 0))
+                    elif ctype == CType.C_FUNCTION:
+                        function_name = parser.arg1()
+                        self.functions[function_name] = len(self.code)
+                        self.code.append((FUNCTION, parser.arg2(), 0))
+                    elif ctype == CType.C_CALL:
+                        fixups.append((len(self.code), parser.arg1()))
+                        self.code.append((CALL, None, parser.arg2()))
+                    elif ctype == CType.C_RETURN:
+                        self.code.append((RETURN, 0, 0))
+                    elif ctype == CType.C_ARITHMETIC:
+                        self.code.append((ARITHMETIC_OPS[parser.arg1()], 0,
+                                          0))
+                    else:
+                        self.code.append(self.compilePushPop(
+                            ctype, parser.arg1(), parser.arg2(), filename))
+                    parser.advance()
+        for index, name in fixups:
+            op, _, y = self.code[index]
+            if op == CALL:
+                if name not in self.functions:
+                    raise ValueError('Unknown function: ' + name)
+                target = self.functions[name]
+            else:
+                if name not in labels:
+                    raise ValueError('Unknown label: ' + name)
+                target = labels[name]
+                if op == GOTO and target == index:
+                    op = HALT
+            self.code[index] = (op, target, y)
+
+    def compilePushPop(self, ctype, segment, index, filename):
+        push = ctype == CType.C_PUSH
+        if segment == 'constant':
+            return (PUSH_CONSTANT, index & WORD_MASK, 0)
+        elif segment in SEGMENT_POINTERS:
+            return (PUSH_SEGMENT if push else POP_SEGMENT,
+                    SEGMENT_POINTERS[segment], index)
+        elif segment == 'static':
+            address = self.staticAddress(filename, index)
+        elif segment == 'temp':
+            address = 5 + index
+        else:  # segment == 'pointer'
+            address = 3 + index
+        return (PUSH_ADDRESS if push else POP_ADDRESS, address, 0)
+
+    def reset(self):
+        # With Sys.init the bootstrap calls it, with a return address past
+        # the end of the code; otherwise execution starts at the top.
+        # array('H') boxes a new int on every read, about 20% slower
+        self.ram = [0] * RAM_SIZE
+        self.ram[0] = 256
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+        # per-command execution counts, only kept when a subclass such as
+        # VMProfiler sets them; then enter and leave are called as well
+        self.counts = None
+        self.peak_sp = self.ram[0]
+        if self.has_sys_init and 'Sys.init' in self.functions:
+            ram = self.ram
+            ram[256] = len(self.code)
+            ram[257:261] = ram[1:5]
+            ram[2] = 256
+            ram[0] = ram[1] = 261
+            self.pc = self.functions['Sys.init']
+
+    def enter(self, target, count, sp):
+        # a call to the function at code index target, count commands into
+        # the current run, with the arguments below sp
+        pass
+
+    def leave(self, count):
+        pass
+
+    def peek(self, address):
+        value = self.ram[address]
+        return value - 0x10000 if value & 0x8000 else value
+
+    def run(self, steps=None):
+        # Runs until the program halts or the given number of VM commands
+        # has been executed, and returns the number of commands executed.
+        code = self.code
+        ram = self.ram
+        counts = self.counts
+        profiling = counts != None
+        size = len(code)
+        pc = self.pc
+        sp = ram[0]
+        peak_sp = self.peak_sp
+        limit = steps if steps != None else -1
+        count = 0
+        while count != limit and pc < size:
+            op, x, y = code[pc]
+            if profiling:
+                counts[pc] += 1
+                if sp > peak_sp:
+                    peak_sp = sp
+            pc += 1
+            count += 1
+            if op == PUSH_SEGMENT:
+                ram[sp] = ram[(ram[x] + y) & 0x7FFF]
+                sp += 1
+            elif op == PUSH_CONSTANT:
+                ram[sp] = x
+                sp += 1
+            elif op == POP_SEGMENT:
+                sp -= 1
+                ram[(ram[x] + y) & 0x7FFF] = ram[sp]
+            elif op == PUSH_ADDRESS:
+                ram[sp] = ram[x]
+                sp += 1
+            elif op == POP_ADDRESS:
+                sp -= 1
+                ram[x] = ram[sp]
+            elif op == ADD:
+                sp -= 1
+                ram[sp-1] = (ram[sp-1] + ram[sp]) & WORD_MASK
+            elif op == SUB:
+                sp -= 1
+                ram[sp-1] = (ram[sp-1] - ram[sp]) & WORD_MASK
+            elif op == IF_GOTO:
+                sp -= 1
+                if ram[sp]:
+                    pc = x
+            elif op == GOTO:
+                pc = x
+            elif op == CALL:
+                if profiling:
+                    self.enter(x, count, sp)
+                ram[sp] = pc
+                ram[sp+1] = ram[1]
+                ram[sp+2] = ram[2]
+                ram[sp+3] = ram[3]
+                ram[sp+4] = ram[4]
+                sp += 5
+                ram[2] = sp - 5 - y
+                ram[1] = sp
+                pc = x
+            elif op == FUNCTION:
+                ram[sp:sp+x] = [0] * x
+                sp += x
+            elif op == RETURN:
+                if profiling:
+                    self.leave(count)
+                frame = ram[1]
+                arg = ram[2]
+                pc = ram[(frame-5) & 0x7FFF]
+                ram[arg] = ram[sp-1]
+                sp = arg + 1
+                ram[1:5] = ram[frame-4:frame]
+            elif op == EQ:
+                sp -= 1
+                ram[sp-1] = WORD_MASK if ram[sp-1] == ram[sp] else 0
+            elif op == GT:
+                # like the Hack build: the sign of the 16-bit x-y, which
+                # overflows
+                sp -= 1
+                ram[sp-1] = (WORD_MASK
+                             if 0 < (ram[sp-1] - ram[sp]) & WORD_MASK < 0x8000
+                             else 0)
+            elif op == LT:
+                sp -= 1
+                ram[sp-1] = (WORD_MASK if (ram[sp-1] - ram[sp]) & 0x8000
+                             else 0)
+            elif op == AND:
+                sp -= 1
+                ram[sp-1] &= ram[sp]
+            elif op == OR:
+                sp -= 1
+                ram[sp-1] |= ram[sp]
+            elif op == NEG:
+                ram[sp-1] = -ram[sp-1] & WORD_MASK
+            elif op == NOT:
+                ram[sp-1] ^= WORD_MASK
+            else:  # op == HALT
+                pc -= 1
+                count -= 1
+                if profiling:
+                    counts[pc] -= 1
+                self.halted = True
+                break
+        if pc >= size:
+            self.halted = True
+        ram[0] = sp
+        self.pc = pc
+        self.peak_sp = max(peak_sp, sp)
+        self.steps += count
+        return count
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    if not args:
+        print('Usage: %s [--steps=N] filename/dirname [address ...]'
+              %sys.argv[0])
+        sys.exit(1)
+    steps = None
+    for flag in flags:
+        if flag.startswith('--steps='):
+            steps = int(flag.split('=')[1])
+    interpreter = VMInterpreter(ListVmFile(os.path.relpath(args[0])))
+    interpreter.run(steps)
+    print('%d commands%s'%(interpreter.steps,
+                           ', halted' if interpreter.halted else ''))
+    for address in args[1:]:
+        print('%s: %d'%(address, interpreter.peek(int(address))))
+
+if __name__ == '__main__':
+    main()
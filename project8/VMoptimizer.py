@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+Optimizes the VM commands of one file before they are translated. Commands
+are tuples as VMtranslator.ParseCommand returns them, e.g.
+('push', 'constant', 7) or ('add',), and three commands are added:
+('move', src_segment, src_index, dst_segment, dst_index) for a push
+directly followed by a pop, ('discard',) for a pop whose value is never
+used, and ('tailcall', function, nargs) for a call directly followed by a
+return.
+"""
+
+WORD_MASK = 0xFFFF
+
+
+def ToSigned(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def Difference(x, y):
+    # x-y as the translated lt and gt see it, a signed 16-bit value that
+    # overflows
+    return ToSigned((x - y) & WORD_MASK)
+
+
+# folded results of constant operands, as 16-bit words
+BINARY_OPS = {'add': lambda x, y: (x + y) & WORD_MASK,
+              'sub': lambda x, y: (x - y) & WORD_MASK,
+              'and': lambda x, y: x & y,
+              'or': lambda x, y: x | y,
+              'eq': lambda x, y: WORD_MASK if x == y else 0,
+              'lt': lambda x, y: WORD_MASK if Difference(x, y) < 0 else 0,
+              'gt': lambda x, y: WORD_MASK if Difference(x, y) > 0 else 0}
+UNARY_OPS = {'neg': lambda x: -x & WORD_MASK,
+             'not': lambda x: x ^ WORD_MASK}
+
+
+def ConstantCommands(value):
+    # shortest commands pushing a 16-bit word; constants only go up to 32767
+    if value <= 0x7FFF:
+        return [('push', 'constant', value)]
+    elif value == 0x8000:
+        return [('push', 'constant', 0x7FFF), ('not',)]
+    return [('push', 'constant', -value & WORD_MASK), ('neg',)]
+
+
+def ConstantTail(commands):
+    # (value, number of commands) if commands end with pushing a constant
+    if commands and commands[-1][:2] == ('push', 'constant'):
+        return commands[-1][2], 1
+    if (len(commands) > 1 and commands[-1][0] in UNARY_OPS
+            and commands[-2][:2] == ('push', 'constant')):
+        return UNARY_OPS[commands[-1][0]](commands[-2][2]), 2
+    return None, 0
+
+
+def FoldConstants(commands):
+    out = []
+    for command in commands:
+        cmd = command[0]
+        if cmd in BINARY_OPS:
+            y, y_length = ConstantTail(out)
+            x, x_length = ConstantTail(out[:-y_length])
+            if y_length and x_length:
+                del out[-x_length-y_length:]
+                out.extend(ConstantCommands(BINARY_OPS[cmd](x, y)))
+                continue
+        elif cmd in UNARY_OPS:
+            x, x_length = ConstantTail(out)
+            if x_length:
+                del out[-x_length:]
+                out.extend(ConstantCommands(UNARY_OPS[cmd](x)))
+                continue
+        out.append(command)
+    return out, len(commands) - len(out)
+
+
+def FuseMoves(commands):
+    # push X / pop Y -> move X Y, and push X / pop X goes away
+    out = []
+    i = 0
+    while i < len(commands):
+        command = commands[i]
+        if (command[0] == 'push' and i+1 < len(commands)
+                and commands[i+1][0] == 'pop'):
+            pop = commands[i+1]
+            if command[1:] != pop[1:]:
+                out.append(('move',) + command[1:] + pop[1:])
+            i += 2
+            continue
+        out.append(command)
+        i += 1
+    return out, len(commands) - len(out)
+
+
+def TempStored(command):
+    if command[0] == 'pop' and command[1] == 'temp':
+        return command[2]
+    if command[0] == 'move' and command[3] == 'temp':
+        return command[4]
+    return None
+
+
+def TempRead(command):
+    if command[0] == 'push' and command[1] == 'temp':
+        return command[2]
+    if command[0] == 'move' and command[1] == 'temp':
+        return command[2]
+    return None
+
+
+def IsDeadStore(commands, i):
+    # A temp value is dead when it is overwritten before anything reads it.
+    # A call neither reads nor overwrites the caller's temps, so the search
+    # goes on past it; labels, branches, returns and function boundaries
+    # end it with the value kept.
+    index = TempStored(commands[i])
+    for command in commands[i+1:]:
+        if TempRead(command) == index:
+            return False
+        if TempStored(command) == index:
+            return True
+        if command[0] in ['label', 'goto', 'if-goto', 'return', 'function']:
+            return False
+    return False
+
+
+def RemoveDeadStores(commands):
+    # the 'pop temp 0' compileDo leaves after a call goes away when the
+    # next do statement overwrites it; a dead 'pop temp' still has to drop
+    # the stack top
+    out = []
+    hits = 0
+    for i, command in enumerate(commands):
+        if TempStored(command) != None and IsDeadStore(commands, i):
+            if command[0] == 'pop':
+                out.append(('discard',))
+            hits += 1
+            continue
+        out.append(command)
+    return out, hits
+
+
+def FuseTailCalls(commands):
+    # call f n / return -> tailcall f n
+    out = []
+    for command in commands:
+        if command == ('return',) and out and out[-1][0] == 'call':
+            out[-1] = ('tailcall',) + out[-1][1:]
+            continue
+        out.append(command)
+    return out, len(commands) - len(out)
+
+
+# Applied in order, folding first so folded constants can be moved
+PASSES = [('fold', FoldConstants),
+          ('move', FuseMoves),
+          ('dead-store', RemoveDeadStores),
+          ('tail-call', FuseTailCalls)]
+
+
+def Optimize(commands, passes=PASSES):
+    # returns the optimized commands and how many commands each pass
+    # removed, or for dead stores, removed or turned into discards
+    hits = {}
+    for name, optimize_pass in passes:
+        commands, count = optimize_pass(commands)
+        hits[name] = count
+    return commands, hits
+
+
+def PrintReport(hits, before, after):
+    for name, _ in PASSES:
+        print('%-20s %d'%(name, hits.get(name, 0)))
+    print('%d -> %d commands'%(before, after))
+
+
+def SplitFunctions(commands):
+    # [(function name, commands)], with None for commands before the first
+    # function
+    functions = []
+    for command in commands:
+        if command[0] == 'function':
+            functions.append((command[1], []))
+        elif not functions:
+            functions.append((None, []))
+        functions[-1][1].append(command)
+    return functions
+
+
+def ReachableFunctions(programs, roots):
+    # names of the functions reachable from roots through call commands;
+    # programs are [(filename, commands)]
+    callees = {}
+    for _, commands in programs:
+        for name, body in SplitFunctions(commands):
+            callees[name] = [command[1] for command in body
+                             if command[0] == 'call']
+    reachable = set()
+    pending = list(roots) + [None]  # code outside functions always runs
+    while pending:
+        name = pending.pop()
+        if name in reachable or name not in callees:
+            continue
+        reachable.add(name)
+        pending.extend(callees[name])
+    return reachable
+
+
+def RemoveDeadFunctions(programs, roots):
+    # returns programs without unreachable functions, and the names of the
+    # functions removed
+    reachable = ReachableFunctions(programs, roots)
+    out = []
+    removed = []
+    for filename, commands in programs:
+        kept = []
+        for name, body in SplitFunctions(commands):
+            if name in reachable:
+                kept.extend(body)
+            else:
+                removed.append(name)
+        out.append((filename, kept))
+    return out, removed
+
+
+def EntryPoints(programs, has_sys_init):
+    # Sys.init with bootstrap code; without it execution starts at the top
+    # of the first file, and Main.main is kept as well
+    if has_sys_init:
+        return ['Sys.init']
+    roots = ['Main.main']
+    for _, commands in programs:
+        functions = SplitFunctions(commands)
+        if functions:
+            roots.append(functions[0][0])
+            break
+    return roots
+
+
+TEMP_SIZE = 8
+INLINE_THRESHOLD = 8  # commands in a function body, not counting return
+POINTER_SEGMENTS = {0: 'this', 1: 'that'}
+
+
+def StackEffect(command):
+    # (values popped, values pushed)
+    cmd = command[0]
+    if cmd == 'push':
+        return 0, 1
+    elif cmd in ['pop', 'discard']:
+        return 1, 0
+    elif cmd in BINARY_OPS:
+        return 2, 1
+    elif cmd in UNARY_OPS:
+        return 1, 1
+    return 0, 0
+
+
+def SegmentIndices(commands, segment):
+    return set(command[2] for command in commands
+               if command[0] in ['push', 'pop'] and command[1] == segment)
+
+
+class InlineCandidate(object):
+    # A leaf function with straight-line code that leaves exactly its
+    # return value on the stack. Arguments and locals are rewritten into
+    # free temp slots at each call site.
+    def __init__(self, filename, body):
+        self.filename = filename
+        self.nlocals = body[0][2]
+        self.body = body[1:-1]
+        self.nargs = max(SegmentIndices(self.body, 'argument') | {-1}) + 1
+        self.uses_static = bool(SegmentIndices(self.body, 'static'))
+        self.pointers = [index for index in POINTER_SEGMENTS
+                         if index in [command[2] for command in self.body
+                                      if command[:2] == ('pop', 'pointer')]]
+
+    @staticmethod
+    def Accepts(body, threshold):
+        if len(body) - 2 > threshold or body[-1] != ('return',):
+            return False
+        depth = 0
+        for command in body[1:-1]:
+            if command[0] in ['label', 'goto', 'if-goto', 'call', 'return',
+                              'function']:
+                return False
+            pops, pushes = StackEffect(command)
+            if depth < pops:
+                return False
+            depth += pushes - pops
+        return depth == 1
+
+    def Expand(self, nargs, free_temps, pointers):
+        # commands replacing 'call f nargs', saving and restoring the given
+        # pointers around the body, or None if they do not fit
+        slots = len(pointers) + nargs + self.nlocals
+        if nargs < self.nargs or slots > len(free_temps):
+            return None
+        saved = free_temps[:len(pointers)]
+        args = free_temps[len(saved):len(saved)+nargs]
+        local_slots = free_temps[len(saved)+nargs:slots]
+        commands = []
+        for index in reversed(args):
+            commands.append(('pop', 'temp', index))
+        for pointer, index in zip(pointers, saved):
+            commands.append(('push', 'pointer', pointer))
+            commands.append(('pop', 'temp', index))
+        for index in local_slots:
+            commands.append(('push', 'constant', 0))
+            commands.append(('pop', 'temp', index))
+        mapping = {'argument': args, 'local': local_slots}
+        for command in self.body:
+            if command[0] in ['push', 'pop'] and command[1] in mapping:
+                command = (command[0], 'temp', mapping[command[1]][command[2]])
+            commands.append(command)
+        for pointer, index in zip(pointers, saved):
+            commands.append(('push', 'temp', index))
+            commands.append(('pop', 'pointer', pointer))
+        return commands
+
+
+def CallerUsesPointer(body, pointer):
+    return bool(SegmentIndices(body, POINTER_SEGMENTS[pointer])
+                or pointer in SegmentIndices(body, 'pointer'))
+
+
+def InlineFunctions(programs, threshold=INLINE_THRESHOLD):
+    # returns programs with calls to small functions inlined, and the
+    # number of calls inlined per function. A temp value may live across a
+    # call, in the caller or in any function further up the stack, so the
+    # expansions only use temp slots no function in the program touches.
+    candidates = {}
+    used = set()
+    for filename, commands in programs:
+        used |= SegmentIndices(commands, 'temp')
+        for name, body in SplitFunctions(commands):
+            if name != None and InlineCandidate.Accepts(body, threshold):
+                candidates[name] = InlineCandidate(filename, body)
+    out = []
+    inlined = {}
+    for filename, commands in programs:
+        kept = []
+        for name, body in SplitFunctions(commands):
+            for command in body:
+                callee = candidates.get(command[1], None) if (
+                    command[0] == 'call') else None
+                if (callee and callee.uses_static
+                        and callee.filename != filename):
+                    callee = None
+                if callee:
+                    # keep the caller's this/that only when it uses them
+                    pointers = [pointer for pointer in callee.pointers
+                                if CallerUsesPointer(body, pointer)]
+                    free_temps = [index for index in range(TEMP_SIZE)
+                                  if index not in used]
+                    expanded = callee.Expand(command[2], free_temps,
+                                             pointers)
+                    if expanded != None:
+                        kept.extend(expanded)
+                        inlined[command[1]] = inlined.get(command[1], 0) + 1
+                        continue
+                kept.append(command)
+        out.append((filename, kept))
+    return out, inlined
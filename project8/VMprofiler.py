@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Profiles VM programs on VMinterpreter: executed commands per function,
+command type and opcode, calls and call-graph edges, peak stack depth and
+heap allocations through Memory.alloc. Writes a JSON report and a
+collapsed-stack file for flame graphs.
+"""
+import array
+import bisect
+import json
+import os
+import sys
+
+import VMinterpreter
+from VMinterpreter import (ARITHMETIC_OPS, CALL, FUNCTION, GOTO, HALT,
+                           IF_GOTO, POP_ADDRESS, POP_SEGMENT, PUSH_ADDRESS,
+                           PUSH_CONSTANT, PUSH_SEGMENT, RETURN)
+from VMtranslator import CType, ListVmFile
+
+ROOT = '[bootstrap]'
+ALLOC_FUNCTION = 'Memory.alloc'
+
+OPCODE_NAMES = {PUSH_CONSTANT: 'push constant', PUSH_SEGMENT: 'push segment',
+                PUSH_ADDRESS: 'push address', POP_SEGMENT: 'pop segment',
+                POP_ADDRESS: 'pop address', GOTO: 'goto', IF_GOTO: 'if-goto',
+                FUNCTION: 'function', CALL: 'call', RETURN: 'return',
+                HALT: 'halt'}
+for name, op in ARITHMETIC_OPS.items():
+    OPCODE_NAMES[op] = name
+
+OPCODE_CTYPES = {PUSH_CONSTANT: CType.C_PUSH, PUSH_SEGMENT: CType.C_PUSH,
+                 PUSH_ADDRESS: CType.C_PUSH, POP_SEGMENT: CType.C_POP,
+                 POP_ADDRESS: CType.C_POP, GOTO: CType.C_GOTO,
+                 IF_GOTO: CType.C_IF, FUNCTION: CType.C_FUNCTION,
+                 CALL: CType.C_CALL, RETURN: CType.C_RETURN,
+                 HALT: CType.C_GOTO}
+for op in ARITHMETIC_OPS.values():
+    OPCODE_CTYPES[op] = CType.C_ARITHMETIC
+
+
+class VMProfiler(VMinterpreter.VMInterpreter):
+    # Attributes every executed command to the function it belongs to and
+    # to the call stack it ran under, kept as a shadow stack of function
+    # names pushed by call and popped by return. The interpreter's loop
+    # keeps the counts and calls enter and leave.
+    def compile(self, inputfiles):
+        VMinterpreter.VMInterpreter.compile(self, inputfiles)
+        self.starts = sorted((index, name) for name, index
+                             in self.functions.items())
+        self.entries = dict(self.starts)
+        self.start_indices = [start for start, _ in self.starts]
+
+    def owner(self, index):
+        # the function the command at index belongs to
+        position = bisect.bisect_right(self.start_indices, index) - 1
+        return self.starts[position][1] if position >= 0 else ROOT
+
+    def reset(self):
+        VMinterpreter.VMInterpreter.reset(self)
+        self.counts = array.array('L', [0]) * len(self.code)
+        self.calls = {}
+        self.edges = {}  # (caller, callee) -> calls
+        self.stacks = {}  # path -> commands
+        self.allocations = {}  # caller -> [calls, words]
+        self.frames = [ROOT]
+        if self.code and self.pc < len(self.code):
+            name = self.owner(self.pc)
+            if name != ROOT:
+                self.frames.append(name)
+                self.calls[name] = 1
+
+    def account(self, count):
+        commands = self.steps + count - self.path_start
+        if commands:
+            path = tuple(self.frames)
+            self.stacks[path] = self.stacks.get(path, 0) + commands
+        self.path_start = self.steps + count
+
+    def enter(self, target, count, sp):
+        name = self.entries[target]
+        caller = self.frames[-1]
+        self.account(count)
+        self.frames.append(name)
+        self.calls[name] = self.calls.get(name, 0) + 1
+        edge = (caller, name)
+        self.edges[edge] = self.edges.get(edge, 0) + 1
+        if name == ALLOC_FUNCTION:
+            stats = self.allocations.setdefault(caller, [0, 0])
+            stats[0] += 1
+            stats[1] += self.ram[sp-1]
+
+    def leave(self, count):
+        self.account(count)
+        if len(self.frames) > 1:
+            self.frames.pop()
+
+    def run(self, steps=None):
+        self.path_start = self.steps
+        count = VMinterpreter.VMInterpreter.run(self, steps)
+        self.account(0)
+        return count
+
+    def functionStats(self):
+        # name -> {commands, inclusive, calls, command types}
+        stats = {}
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            name = self.owner(index)
+            entry = stats.setdefault(name, {'calls': self.calls.get(name, 0),
+                                            'commands': 0, 'inclusive': 0,
+                                            'ctypes': {}})
+            entry['commands'] += count
+            ctype = OPCODE_CTYPES[self.code[index][0]].name
+            entry['ctypes'][ctype] = entry['ctypes'].get(ctype, 0) + count
+        for path, commands in self.stacks.items():
+            for name in set(path):
+                if name in stats:
+                    stats[name]['inclusive'] += commands
+        return stats
+
+    def report(self):
+        ctypes = {}
+        opcodes = {}
+        for index, count in enumerate(self.counts):
+            if count:
+                op = self.code[index][0]
+                ctype = OPCODE_CTYPES[op].name
+                ctypes[ctype] = ctypes.get(ctype, 0) + count
+                opcodes[OPCODE_NAMES[op]] = (opcodes.get(OPCODE_NAMES[op], 0)
+                                             + count)
+        allocations = sorted(self.allocations.items())
+        return {'commands': self.steps,
+                'halted': self.halted,
+                'peak_sp': self.peak_sp,
+                'peak_stack_depth': self.peak_sp - 256,
+                'functions': self.functionStats(),
+                'ctypes': ctypes,
+                'opcodes': opcodes,
+                'call_graph': [{'caller': caller, 'callee': callee,
+                                'calls': calls} for (caller, callee), calls
+                               in sorted(self.edges.items())],
+                'allocations': {
+                    'calls': sum(calls for _, (calls, _) in allocations),
+                    'words': sum(words for _, (_, words) in allocations),
+                    'by_caller': dict((caller, {'calls': calls,
+                                                'words': words})
+                                      for caller, (calls, words)
+                                      in allocations)}}
+
+    def writeCollapsed(self, outfile):
+        with open(outfile, 'w') as f:
+            for path, commands in sorted(self.stacks.items()):
+                f.write('%s %d\n'%(';'.join(path), commands))
+
+    def summary(self, top=20):
+        report = self.report()
+        lines = ['%d commands, peak stack depth %d, %d allocations (%d words)'
+                 %(report['commands'], report['peak_stack_depth'],
+                   report['allocations']['calls'],
+                   report['allocations']['words']), '',
+                 '%-40s %8s %12s %12s'%('function', 'calls', 'inclusive',
+                                        'exclusive')]
+        functions = report['functions']
+        for name in sorted(functions,
+                           key=lambda name: -functions[name]['commands'])[:top]:
+            entry = functions[name]
+            lines.append('%-40s %8d %12d %12d'%(name, entry['calls'],
+                                                entry['inclusive'],
+                                                entry['commands']))
+        return '\n'.join(lines)
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    if not args:
+        print('Usage: %s [--steps=N] [--json=outfile] [--collapsed=outfile] '
+              'filename/dirname'%sys.argv[0])
+        sys.exit(1)
+    steps = None
+    json_file = None
+    collapsed = None
+    for flag in flags:
+        if flag.startswith('--steps='):
+            steps = int(flag.split('=')[1])
+        elif flag.startswith('--json='):
+            json_file = flag.split('=')[1]
+        elif flag.startswith('--collapsed='):
+            collapsed = flag.split('=')[1]
+    profiler = VMProfiler(ListVmFile(os.path.relpath(args[0])))
+    profiler.run(steps)
+    print(profiler.summary())
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(profiler.report(), f, indent=2, sort_keys=True)
+    if collapsed:
+        profiler.writeCollapsed(collapsed)
+
+if __name__ == '__main__':
+    main()
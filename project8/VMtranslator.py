@@ -6,8 +6,12 @@ Created on Sun Oct 15 19:18:05 2017
 """
 import sys
 import enum
+import io
+import multiprocessing
 import os
 
+import VMoptimizer
+
 class CType(enum.Enum):
     C_ARITHMETIC = 1
     C_PUSH = 2
@@ -62,18 +66,76 @@ class Parser(object):
     def arg2(self):
         return int(self.cmd_list[2])
 
+class AsmOutput(object):
+    # Writes the instructions a CodeWriter emits as assembly text
+    def __init__(self, file):
+        self.file = file
+
+    def writeA(self, value):
+        self.file.write('@' + str(value) + '\n')
+
+    def writeC(self, dest, comp, jump):
+        if dest:
+            comp = dest + '=' + comp
+        if jump:
+            comp += '; ' + jump
+        self.file.write(comp + '\n')
+
+    def writeLabel(self, label):
+        self.file.write('(' + label + ')\n')
+
+    def writeComment(self, comment):
+        self.file.write('// ' + comment + '\n')
+
+    def close(self):
+        self.file.close()
+
+
 class CodeWriter(object):
     SEGMENT_TABLE = {'local': 'LCL', 'argument': 'ARG', 'this': 'THIS',
                      'that': 'THAT'}
-    def __init__(self, file):
+    COMPARE_JUMPS = {'eq': 'JEQ', 'lt': 'JLT', 'gt': 'JGT'}
+    MAX_OFFSET_CHAIN = 5  # longest 'A=A+1' chain before indexing with A
+    def __init__(self, file, shared_calls=False, compare_policy='speed'):
+        # file is a text file for assembly, or an object that takes the
+        # instructions as they are, like linker.ObjectBuilder
         self.outputfile = file
+        self.output = file if hasattr(file, 'writeC') else AsmOutput(file)
         self.line_count = 0
         self.function_name = 'null'
         self.return_count = 0
+        self.function_return_count = 0
+        self.tail_count = 0  # tail calls, which PrintSizeReport leaves out
+        # call sites pass the callee in R13, nargs in R14 and the return
+        # address in D to one shared call routine, and every function
+        # returns through one shared return routine
+        self.shared_calls = shared_calls
+        self.shared_routines = []
+        self.linkage_size = 0  # instructions of shared call/return sites
+        # 'speed' inlines eq/lt/gt, 'size' calls one shared routine per
+        # comparison kind with the return address in R15
+        self.compare_policy = compare_policy
+        self.compare_count = 0
+        # output lines holding absolute ROM addresses, for relocation
+        self.relocations = []
+        self.lines_written = 0
         
-    def writeln(self, content):
-        self.outputfile.write(content + '\n')
+    def writeA(self, value):
+        # @value, a number or a symbol
+        self.output.writeA(value)
         self.line_count += 1
+        self.lines_written += 1
+
+    def writeC(self, dest, comp, jump=None):
+        # dest=comp;jump, dest and jump None when left out
+        self.output.writeC(dest, comp, jump)
+        self.line_count += 1
+        self.lines_written += 1
+
+    def writeAddress(self, offset):
+        # @ the ROM address offset instructions ahead of this one
+        self.relocations.append(self.lines_written)
+        self.writeA(self.line_count+offset)
 
     def setFileName(self, filename):
         filename = os.path.split(filename)[1]
@@ -81,10 +143,10 @@ class CodeWriter(object):
     
     def writeInit(self):
         self.writeComments('Initialize')
-        self.writeln('@256')
-        self.writeln('D=A')
-        self.writeln('@SP')
-        self.writeln('M=D')
+        self.writeA(256)
+        self.writeC('D', 'A')
+        self.writeA('SP')
+        self.writeC('M', 'D')
         self.writeCall('Sys.init', 0)
    
     def writeLabel(self, label=None):
@@ -92,208 +154,573 @@ class CodeWriter(object):
             label = self.function_name + '$' + label
         else:
             label = self.function_name
-        self.writeln('(' + label + ')')
-        self.line_count -= 1
+        self.output.writeLabel(label)
+        self.lines_written += 1
         
     def writeIf(self, label):
         label = self.function_name + '$' + label
         self.popD()
-        self.writeln('@' + label)
-        self.writeln('D; JNE')
+        self.writeA(label)
+        self.writeC(None, 'D', 'JNE')
         
     def writeGoto(self, label):
         label = self.function_name + '$' + label
-        self.writeln('@' + label)
-        self.writeln('0; JMP')
+        self.writeA(label)
+        self.writeC(None, '0', 'JMP')
     
     def writeFunction(self, func_name, nvars):
         self.function_name = func_name
         self.return_cnt = 0
         self.writeLabel()
         # D=0
-        self.writeln('@0')
-        self.writeln('D=A')
+        self.writeA(0)
+        self.writeC('D', 'A')
         for _ in range(nvars):
             self.pushD()
             
+    def writeGlobalLabel(self, label):
+        self.output.writeLabel(label)
+        self.lines_written += 1
+
+    def useSharedRoutine(self, name):
+        if name not in self.shared_routines:
+            self.shared_routines.append(name)
+
     def writeCall(self, func_name, nargs):
         # push return address
         self.return_count += 1
         label = 'ret.' + str(self.return_count)
-        self.writeln('@' + self.function_name + '$' + label)
-        self.writeln('D=A')
+        if self.shared_calls:
+            self.useSharedRoutine('__CALL')
+            start = self.line_count
+            self.writeA(func_name)
+            self.writeC('D', 'A')
+            self.writeA('R13')
+            self.writeC('M', 'D')
+            if nargs in (0, 1):
+                self.writeA('R14')
+                self.writeC('M', str(nargs))
+            else:
+                self.writeA(nargs)
+                self.writeC('D', 'A')
+                self.writeA('R14')
+                self.writeC('M', 'D')
+            self.writeA(self.function_name + '$' + label)
+            self.writeC('D', 'A')
+            self.writeA('__CALL')
+            self.writeC(None, '0', 'JMP')
+            self.writeLabel(label)
+            self.linkage_size += self.line_count - start
+            return
+        self.writeA(self.function_name + '$' + label)
+        self.writeC('D', 'A')
         self.pushD()
+        self.writeFrame(nargs)
+        # go to function
+        self.writeA(func_name)
+        self.writeC(None, '0', 'JMP')       
+        # function return
+        self.writeLabel(label)
+
+    def writeTailCall(self, func_name, nargs):
+        # call followed by return: the callee reuses this function's frame
+        # and returns straight to our caller
+        self.tail_count += 1
+        slow = self.function_name + '$tail.' + str(self.tail_count)
+        # the saved frame is already in place when this function got nargs
+        # arguments too, i.e. LCL == ARG+nargs+5
+        self.writeA('LCL')
+        self.writeC('D', 'M')
+        self.writeA('ARG')
+        self.writeC('D', 'D-M')
+        self.writeA(nargs+5)
+        self.writeC('D', 'D-A')
+        self.writeA(slow)
+        self.writeC(None, 'D', 'JNE')
+        # move the arguments down to ARG, then SP = LCL
+        for index in range(nargs):
+            self.writeA('SP')
+            if index == nargs - 1:
+                self.writeC('A', 'M-1')
+            else:
+                self.writeC('D', 'M')
+                self.writeA(nargs-index)
+                self.writeC('A', 'D-A')
+            self.writeC('D', 'M')
+            self.storeD('argument', index)
+        self.writeA('LCL')
+        self.writeC('D', 'M')
+        self.writeA('SP')
+        self.writeC('M', 'D')
+        self.writeA(func_name)
+        self.writeC(None, '0', 'JMP')
+        # otherwise the shared routine rebuilds the frame above ARG
+        self.writeGlobalLabel(slow)
+        self.useSharedRoutine('__TAILCALL')
+        self.writeA(func_name)
+        self.writeC('D', 'A')
+        self.writeA('R13')
+        self.writeC('M', 'D')
+        self.writeA(nargs)
+        self.writeC('D', 'A')
+        self.writeA('R14')
+        self.writeC('M', 'D')
+        self.writeA('__TAILCALL')
+        self.writeC(None, '0', 'JMP')
+
+    def writeTailCallBody(self):
+        # R13 = callee, R14 = nargs. Copy the saved frame above the
+        # arguments, move both down to ARG, then LCL = SP = ARG+nargs+5.
+        for offset in range(5, 0, -1):
+            self.writeA('LCL')
+            self.writeC('D', 'M')
+            self.writeA(offset)
+            self.writeC('A', 'D-A')
+            self.writeC('D', 'M')
+            self.pushD()
+        # R15 = SP-nargs-5 is the source, LCL walks the destination
+        self.writeA('SP')
+        self.writeC('D', 'M')
+        self.writeA('R14')
+        self.writeC('D', 'D-M')
+        self.writeA(5)
+        self.writeC('D', 'D-A')
+        self.writeA('R15')
+        self.writeC('M', 'D')
+        self.writeA('ARG')
+        self.writeC('D', 'M')
+        self.writeA('LCL')
+        self.writeC('M', 'D')
+        self.writeGlobalLabel('__TAILCALL.LOOP')
+        self.writeA('R15')
+        self.writeC('D', 'M')
+        self.writeA('SP')
+        self.writeC('D', 'D-M')
+        self.writeA('__TAILCALL.END')
+        self.writeC(None, 'D', 'JGE')
+        self.writeA('R15')
+        self.writeC('AM', 'M+1')
+        self.writeC('A', 'A-1')
+        self.writeC('D', 'M')
+        self.writeA('LCL')
+        self.writeC('AM', 'M+1')
+        self.writeC('A', 'A-1')
+        self.writeC('M', 'D')
+        self.writeA('__TAILCALL.LOOP')
+        self.writeC(None, '0', 'JMP')
+        self.writeGlobalLabel('__TAILCALL.END')
+        self.writeA('LCL')
+        self.writeC('D', 'M')
+        self.writeA('SP')
+        self.writeC('M', 'D')
+        self.writeA('R13')
+        self.writeC('A', 'M')
+        self.writeC(None, '0', 'JMP')
+
+    def writeFrame(self, nargs=None):
+        # nargs=None takes the argument count from R14
         # push LCL, ARG, THIS, THAT
         for saved in ['LCL', 'ARG', 'THIS', 'THAT']:
-            self.writeln('@' + saved)
-            self.writeln('D=M')
+            self.writeA(saved)
+            self.writeC('D', 'M')
             self.pushD()       
         # ARG=SP-5-nargs
-        self.writeln('@SP')
-        self.writeln('D=M')
-        self.writeln('@5')
-        self.writeln('D=D-A')
-        self.writeln('@' + str(nargs))
-        self.writeln('D=D-A')
-        self.writeln('@ARG')
-        self.writeln('M=D')        
+        self.writeA('SP')
+        self.writeC('D', 'M')
+        self.writeA(5)
+        self.writeC('D', 'D-A')
+        if nargs == None:
+            self.writeA('R14')
+            self.writeC('D', 'D-M')
+        else:
+            self.writeA(nargs)
+            self.writeC('D', 'D-A')
+        self.writeA('ARG')
+        self.writeC('M', 'D')        
         # LCL=SP
-        self.writeln('@SP')
-        self.writeln('D=M')
-        self.writeln('@LCL')
-        self.writeln('M=D')        
-        # go to function
-        self.writeln('@' + func_name)
-        self.writeln('0; JMP')       
-        # function return
-        self.writeLabel(label)
+        self.writeA('SP')
+        self.writeC('D', 'M')
+        self.writeA('LCL')
+        self.writeC('M', 'D')        
     
     def writeReturn(self):
+        self.function_return_count += 1
+        if self.shared_calls:
+            self.useSharedRoutine('__RETURN')
+            self.writeA('__RETURN')
+            self.writeC(None, '0', 'JMP')
+            self.linkage_size += 2
+            return
+        self.writeReturnBody()
+
+    def writeReturnBody(self):
         # endframe = LCL
-        self.writeln('@LCL')
-        self.writeln('D=M')
-        self.writeln('@R13')  # R13=endframe
-        self.writeln('M=D')
-        self.writeln('@5')
-        self.writeln('D=D-A')
-        self.writeln('A=D')
-        self.writeln('D=M')
+        self.writeA('LCL')
+        self.writeC('D', 'M')
+        self.writeA('R13')  # R13=endframe
+        self.writeC('M', 'D')
+        self.writeA(5)
+        self.writeC('D', 'D-A')
+        self.writeC('A', 'D')
+        self.writeC('D', 'M')
         # returnattr = *(endframe-5)
-        self.writeln('@R14')  # R14=returnattr
-        self.writeln('M=D')
+        self.writeA('R14')  # R14=returnattr
+        self.writeC('M', 'D')
         # *ARG = pop()
         self.popD()
-        self.writeln('@ARG')
-        self.writeln('A=M')
-        self.writeln('M=D')
+        self.writeA('ARG')
+        self.writeC('A', 'M')
+        self.writeC('M', 'D')
         # SP = ARG + 1
-        self.writeln('D=A')
-        self.writeln('@SP')
-        self.writeln('M=D+1')
+        self.writeC('D', 'A')
+        self.writeA('SP')
+        self.writeC('M', 'D+1')
         # restore LCL, ARG, THIS, THAT
         for saved in ['THAT', 'THIS', 'ARG', 'LCL']:
-            self.writeln('@R13')
-            self.writeln('AM=M-1')
-            self.writeln('D=M')
-            self.writeln('@' + saved)
-            self.writeln('M=D')
+            self.writeA('R13')
+            self.writeC('AM', 'M-1')
+            self.writeC('D', 'M')
+            self.writeA(saved)
+            self.writeC('M', 'D')
         # go to returnattr
-        self.writeln('@R14')
-        self.writeln('A=M')
-        self.writeln('0; JMP')
+        self.writeA('R14')
+        self.writeC('A', 'M')
+        self.writeC(None, '0', 'JMP')
+
+    def writeSharedRoutines(self):
+        if not self.shared_routines:
+            return
+        # keep execution from falling into the routines
+        self.writeComments('Shared routines')
+        self.writeGlobalLabel('__END')
+        self.writeA('__END')
+        self.writeC(None, '0', 'JMP')
+        for name in self.shared_routines:
+            self.writeGlobalLabel(name)
+            if name == '__CALL':
+                self.pushD()
+                self.writeFrame()
+                self.writeA('R13')
+                self.writeC('A', 'M')
+                self.writeC(None, '0', 'JMP')
+            elif name == '__RETURN':
+                self.writeReturnBody()
+            elif name == '__TAILCALL':
+                self.writeTailCallBody()
+            else:  # shared comparison, '__EQ', '__LT' or '__GT'
+                self.writeA('R15')
+                self.writeC('M', 'D')
+                self.writeCompareBody(name[2:].lower(), name + '.TRUE')
+                self.writeA('R15')
+                self.writeC('A', 'M')
+                self.writeC(None, '0', 'JMP')
     
+    def writeCompare(self, cmd):
+        if self.compare_policy == 'size':
+            name = '__' + cmd.upper()
+            self.useSharedRoutine(name)
+            self.compare_count += 1
+            label = 'cmp.' + str(self.compare_count)
+            self.writeA(self.function_name + '$' + label)
+            self.writeC('D', 'A')
+            self.writeA(name)
+            self.writeC(None, '0', 'JMP')
+            self.writeLabel(label)
+        else:
+            self.writeCompareBody(cmd)
+
+    def writeCompareBody(self, cmd, true_label=None):
+        # x = -1, then x = 0 unless the comparison holds
+        self.writeA('SP')
+        self.writeC('AM', 'M-1')
+        self.writeC('D', 'M')
+        self.writeC('A', 'A-1')
+        self.writeC('D', 'M-D')
+        self.writeC('M', '-1')
+        if true_label:
+            self.writeA(true_label)
+        else:
+            self.writeAddress(5)
+        self.writeC(None, 'D', self.COMPARE_JUMPS[cmd])
+        self.writeA('SP')
+        self.writeC('A', 'M-1')
+        self.writeC('M', '0')
+        if true_label:
+            self.writeGlobalLabel(true_label)
+
     def writeArithmetic(self, cmd):
+        if cmd in self.COMPARE_JUMPS:
+            self.writeCompare(cmd)
+            return
         if cmd in ['not', 'neg']:
-            self.writeln('@SP')
-            self.writeln('A=M-1')
+            self.writeA('SP')
+            self.writeC('A', 'M-1')
             if cmd == 'not':
-                self.writeln('M=!M')
+                self.writeC('M', '!M')
             else:  # cmd == 'neg'
-                self.writeln('M=-M')
+                self.writeC('M', '-M')
             return        
-        self.writeln('@SP')
-        self.writeln('M=M-1')
-        self.writeln('A=M')
-        self.writeln('D=M')
-        self.writeln('A=A-1')
+        self.writeA('SP')
+        self.writeC('M', 'M-1')
+        self.writeC('A', 'M')
+        self.writeC('D', 'M')
+        self.writeC('A', 'A-1')
         if cmd == 'add':
-            self.writeln('M=D+M')
+            self.writeC('M', 'D+M')
         elif cmd == 'sub':
-            self.writeln('M=M-D')
+            self.writeC('M', 'M-D')
         elif cmd == 'and':
-            self.writeln('M=D&M')
+            self.writeC('M', 'D&M')
         elif cmd == 'or':
-            self.writeln('M=D|M')
-        elif cmd in ['eq', 'lt', 'gt']:
-            self.writeln('D=M-D')
-            self.writeln('@' + str(self.line_count+7))
-            if cmd == 'eq':
-                self.writeln('D; JEQ')
-            elif cmd == 'lt':
-                self.writeln('D; JLT')
-            else:  # cmd == 'gt'
-                self.writeln('D; JGT')
-            self.writeln('@SP')
-            self.writeln('A=M-1')
-            self.writeln('M=0')
-            self.writeln('@' + str(self.line_count+5))
-            self.writeln('0; JMP')
-            self.writeln('@SP')
-            self.writeln('A=M-1')
-            self.writeln('M=-1')
+            self.writeC('M', 'D|M')
     
     def popD(self):
-        self.writeln('@SP')
-        self.writeln('M=M-1')
-        self.writeln('A=M')
-        self.writeln('D=M')
+        self.writeA('SP')
+        self.writeC('M', 'M-1')
+        self.writeC('A', 'M')
+        self.writeC('D', 'M')
     
     def pushD(self):
-        self.writeln('@SP')
-        self.writeln('A=M')
-        self.writeln('M=D')
-        self.writeln('@SP')
-        self.writeln('M=M+1')
+        self.writeA('SP')
+        self.writeC('A', 'M')
+        self.writeC('M', 'D')
+        self.writeA('SP')
+        self.writeC('M', 'M+1')
             
     def writePushPop(self, cmd, segment, index):
         seg_pt = self.SEGMENT_TABLE.get(segment, None)
         if cmd == CType.C_PUSH:
-            if seg_pt:
-                self.writeln('@' + seg_pt)
-                self.writeln('D=M')
-                self.writeln('@' + str(index))
-                self.writeln('A=D+A')
-                self.writeln('D=M')             
-            elif segment == 'constant':
-                self.writeln('@' + str(index))
-                self.writeln('D=A')
-            elif segment == 'static':
-                self.writeln('@' + self.filename + '.' + str(index))
-                self.writeln('D=M')
-            elif segment == 'temp':
-                self.writeln('@' + str(5+index))
-                self.writeln('D=M')
-            else:  # segment == 'pointer'
-                if index == '0':
-                    self.writeln('@THIS')
-                else:
-                    self.writeln('@THAT')
-                self.writeln('D=M')
+            self.loadD(segment, index)
             self.pushD()
         else:  # cmd == CType.C_POP
             if seg_pt:
-                self.writeln('@' + str(index))
-                self.writeln('D=A')
-                self.writeln('@' + seg_pt)
-                self.writeln('D=D+M')
-                self.writeln('@R13')
-                self.writeln('M=D')
+                self.writeA(index)
+                self.writeC('D', 'A')
+                self.writeA(seg_pt)
+                self.writeC('D', 'D+M')
+                self.writeA('R13')
+                self.writeC('M', 'D')
                 self.popD()                
-                self.writeln('@R13')
-                self.writeln('A=M')
-                self.writeln('M=D')
-            elif segment == 'static':
-                self.popD()
-                self.writeln('@' + self.filename + '.' + str(index))
-                self.writeln('M=D')
-            elif segment == 'temp':
-                self.popD()
-                self.writeln('@' + str(5+index))
-                self.writeln('M=D')
-            else:  # segment == 'pointer'
+                self.writeA('R13')
+                self.writeC('A', 'M')
+                self.writeC('M', 'D')
+            else:
                 self.popD()
-                if index == 0:
-                    self.writeln('@THIS')
-                else:
-                    self.writeln('@THAT')
-                self.writeln('M=D')
+                self.storeD(segment, index)
+
+    def loadD(self, segment, index):
+        # D = segment[index]
+        seg_pt = self.SEGMENT_TABLE.get(segment, None)
+        if seg_pt:
+            self.writeA(seg_pt)
+            self.writeC('D', 'M')
+            self.writeA(index)
+            self.writeC('A', 'D+A')
+            self.writeC('D', 'M')
+        elif segment == 'constant':
+            self.writeA(index)
+            self.writeC('D', 'A')
+        else:
+            self.writeA(self.directAddress(segment, index))
+            self.writeC('D', 'M')
+
+    def storeD(self, segment, index):
+        # segment[index] = D
+        seg_pt = self.SEGMENT_TABLE.get(segment, None)
+        if not seg_pt:
+            self.writeA(self.directAddress(segment, index))
+            self.writeC('M', 'D')
+        elif index <= self.MAX_OFFSET_CHAIN:
+            self.writeA(seg_pt)
+            self.writeC('A', 'M')
+            for _ in range(index):
+                self.writeC('A', 'A+1')
+            self.writeC('M', 'D')
+        else:
+            # R13 = value, D = value+address, A = D-value, M = D-A
+            self.writeA('R13')
+            self.writeC('M', 'D')
+            self.writeA(seg_pt)
+            self.writeC('D', 'D+M')
+            self.writeA(index)
+            self.writeC('D', 'D+A')
+            self.writeA('R13')
+            self.writeC('A', 'D-M')
+            self.writeC('M', 'D-A')
+
+    def writeMove(self, src_segment, src_index, dst_segment, dst_index):
+        # push src_segment src_index / pop dst_segment dst_index, without
+        # going through the stack
+        if (src_segment == 'constant' and src_index in (0, 1)
+                and dst_segment not in self.SEGMENT_TABLE):
+            self.writeA(self.directAddress(dst_segment, dst_index))
+            self.writeC('M', str(src_index))
+            return
+        self.loadD(src_segment, src_index)
+        self.storeD(dst_segment, dst_index)
+
+    def writeDiscard(self):
+        # drop the stack top
+        self.writeA('SP')
+        self.writeC('M', 'M-1')
+
+    def directAddress(self, segment, index):
+        if segment == 'static':
+            return self.filename + '.' + str(index)
+        elif segment == 'temp':
+            return 5 + index
+        else:  # segment == 'pointer'
+            return 'THIS' if index == 0 else 'THAT'
         
     def writeComments(self, comment):
-        self.writeln('// ' + comment)
-        self.line_count -= 1
+        self.output.writeComment(comment)
+        self.lines_written += 1
+
+    def endFile(self):
+        # nothing is carried from one command to the next
+        pass
         
     def Close(self):
-        self.outputfile.close()
+        self.output.close()
+
+
+class TosCodeWriter(CodeWriter):
+    # Keeps the top of the VM stack in D between commands. While cached is
+    # set, the stack in memory holds everything below the top and SP points
+    # just past it. The top is spilled to memory before labels, jumps,
+    # calls and returns, so every label is reached with the whole stack in
+    # memory.
+    ARITHMETIC_COMPS = {'add': 'D+M', 'sub': 'M-D', 'and': 'D&M',
+                        'or': 'D|M'}
+    CONSTANT_COMPS = {0: '0', 1: '1'}
+
+    def __init__(self, file, shared_calls=False, compare_policy='speed'):
+        CodeWriter.__init__(self, file, shared_calls, compare_policy)
+        self.cached = False
+
+    def spill(self):
+        if self.cached:
+            self.writeA('SP')
+            self.writeC('M', 'M+1')
+            self.writeC('A', 'M-1')
+            self.writeC('M', 'D')
+            self.cached = False
+
+    def fill(self):
+        if not self.cached:
+            self.writeA('SP')
+            self.writeC('AM', 'M-1')
+            self.writeC('D', 'M')
+            self.cached = True
+
+    def endFile(self):
+        self.spill()
+
+    def writeLabel(self, label=None):
+        self.spill()
+        CodeWriter.writeLabel(self, label)
+
+    def writeIf(self, label):
+        self.fill()
+        self.cached = False
+        self.writeA(self.function_name + '$' + label)
+        self.writeC(None, 'D', 'JNE')
+
+    def writeGoto(self, label):
+        self.spill()
+        CodeWriter.writeGoto(self, label)
+
+    def writeFunction(self, func_name, nvars):
+        self.spill()
+        self.function_name = func_name
+        self.writeLabel()
+        if nvars:
+            # zero the locals in place and bump SP once
+            self.writeA('SP')
+            self.writeC('A', 'M')
+            for i in range(nvars):
+                if i:
+                    self.writeC('A', 'A+1')
+                self.writeC('M', '0')
+            self.writeC('D', 'A+1')
+            self.writeA('SP')
+            self.writeC('M', 'D')
+
+    def writeCall(self, func_name, nargs):
+        self.spill()
+        CodeWriter.writeCall(self, func_name, nargs)
+
+    def writeReturn(self):
+        self.spill()
+        CodeWriter.writeReturn(self)
+
+    def writeTailCall(self, func_name, nargs):
+        self.spill()
+        CodeWriter.writeTailCall(self, func_name, nargs)
+
+    def writeCompare(self, cmd):
+        if self.compare_policy == 'size':
+            self.spill()
+            CodeWriter.writeCompare(self, cmd)
+            return
+        # D = x-y, then D = -1 if the comparison holds and 0 otherwise
+        self.fill()
+        self.writeA('SP')
+        self.writeC('AM', 'M-1')
+        self.writeC('D', 'M-D')
+        self.writeAddress(5)
+        self.writeC(None, 'D', self.COMPARE_JUMPS[cmd])
+        self.writeC('D', '0')
+        self.writeAddress(3)
+        self.writeC(None, '0', 'JMP')
+        self.writeC('D', '-1')
+
+    def writeArithmetic(self, cmd):
+        if cmd in self.COMPARE_JUMPS:
+            self.writeCompare(cmd)
+        elif cmd in ['not', 'neg']:
+            if self.cached:
+                self.writeC('D', '!D' if cmd == 'not' else '-D')
+            else:
+                CodeWriter.writeArithmetic(self, cmd)
+        else:
+            self.fill()
+            self.writeA('SP')
+            self.writeC('AM', 'M-1')
+            self.writeC('D', self.ARITHMETIC_COMPS[cmd])
+
+    def writePushPop(self, cmd, segment, index):
+        if cmd == CType.C_PUSH:
+            self.spill()
+            if segment == 'constant' and index in self.CONSTANT_COMPS:
+                self.writeC('D', self.CONSTANT_COMPS[index])
+            else:
+                self.loadD(segment, index)
+            self.cached = True
+            return
+        self.fill()
+        self.cached = False
+        self.storeD(segment, index)
+
+    def writeMove(self, src_segment, src_index, dst_segment, dst_index):
+        self.spill()
+        CodeWriter.writeMove(self, src_segment, src_index, dst_segment,
+                             dst_index)
+
+    def writeDiscard(self):
+        if self.cached:
+            self.cached = False
+        else:
+            CodeWriter.writeDiscard(self)
+
+    def loadD(self, segment, index):
+        seg_pt = self.SEGMENT_TABLE.get(segment, None)
+        if seg_pt and index <= 1:
+            self.writeA(seg_pt)
+            self.writeC('A', 'M' if index == 0 else 'M+1')
+            self.writeC('D', 'M')
+        else:
+            CodeWriter.loadD(self, segment, index)
 
 
 def ListVmFile(path):
@@ -308,11 +735,195 @@ def ListVmFile(path):
     return ret
 
 
+def ParseCommand(parser):
+    # the current command as a tuple, e.g. ('push', 'local', 2), ('add',)
+    # or ('label', 'LOOP')
+    ctype = parser.currentCommandType()
+    cmd = parser.cmd_list[0]
+    if ctype in [CType.C_PUSH, CType.C_POP, CType.C_FUNCTION, CType.C_CALL]:
+        return (cmd, parser.arg1(), parser.arg2())
+    elif ctype in [CType.C_LABEL, CType.C_IF, CType.C_GOTO]:
+        return (cmd, parser.arg1())
+    return (cmd,)
+
+
+def ReadCommands(in_f):
+    parser = Parser(in_f)
+    commands = []
+    while parser.hasMoreCommands():
+        commands.append(ParseCommand(parser))
+        parser.advance()
+    return commands
+
+
+def WriteCommand(writer, command):
+    cmd = command[0]
+    ctype = Parser.CMD_TYPE_TABLE.get(cmd, None)
+    if ctype == CType.C_ARITHMETIC:
+        writer.writeArithmetic(cmd)
+    elif ctype == CType.C_POP or ctype == CType.C_PUSH :
+        writer.writePushPop(ctype, command[1], command[2])
+    elif ctype == CType.C_LABEL:
+        writer.writeLabel(command[1])
+    elif ctype == CType.C_IF:
+        writer.writeIf(command[1])
+    elif ctype == CType.C_GOTO:
+        writer.writeGoto(command[1])
+    elif ctype == CType.C_FUNCTION:
+        writer.writeFunction(command[1], command[2])
+    elif ctype == CType.C_CALL:
+        writer.writeCall(command[1], command[2])
+    elif ctype == CType.C_RETURN:
+        writer.writeReturn()
+    elif cmd == 'move':  # commands only VMoptimizer writes
+        writer.writeMove(*command[1:])
+    elif cmd == 'tailcall':
+        writer.writeTailCall(command[1], command[2])
+    elif cmd == 'discard':
+        writer.writeDiscard()
+    else:
+        raise NotImplementedError('Command type not implemented!')  
+
+
+def TranslateCommands(writer, inputfile, commands, stats=None):
+    # passing a stats dict runs VMoptimizer first and adds its hits and the
+    # command counts before and after to stats
+    writer.setFileName(inputfile)
+    if stats != None:
+        stats['before'] = stats.get('before', 0) + len(commands)
+        commands, hits = VMoptimizer.Optimize(commands)
+        stats['after'] = stats.get('after', 0) + len(commands)
+        for name, count in hits.items():
+            stats[name] = stats.get(name, 0) + count
+    for command in commands:
+        writer.writeComments(' '.join(str(arg) for arg in command))
+        WriteCommand(writer, command)
+    writer.endFile()
+
+
+def TranslateFile(writer, inputfile, in_f, stats=None):
+    if stats != None:
+        TranslateCommands(writer, inputfile, ReadCommands(in_f), stats)
+        return
+    writer.setFileName(inputfile)
+    parser = Parser(in_f)
+    while parser.hasMoreCommands():
+        writer.writeComments(parser.current_command)
+        WriteCommand(writer, ParseCommand(parser))
+        parser.advance()
+    writer.endFile()
+
+
+class Fragment(object):
+    # Assembly of one VM file translated on its own from ROM address 0,
+    # with what the link step needs to place it after other fragments
+    def __init__(self, writer, stats):
+        self.text = writer.outputfile.getvalue()
+        self.relocations = writer.relocations
+        self.line_count = writer.line_count
+        self.return_count = writer.return_count
+        self.function_return_count = writer.function_return_count
+        self.linkage_size = writer.linkage_size
+        self.shared_routines = writer.shared_routines
+        self.stats = stats
+
+
+def TranslateFragment(job):
+    # job is (inputfile, commands or None to read the file, options) with
+    # options (writer class, shared_calls, compare_policy, optimize)
+    inputfile, commands, options = job
+    writer_class, shared_calls, compare_policy, optimize = options
+    writer = writer_class(io.StringIO(), shared_calls, compare_policy)
+    # labels of code outside functions are unique to the file
+    writer.setFileName(inputfile)
+    writer.function_name = writer.filename
+    stats = {} if optimize else None
+    if commands == None:
+        with open(inputfile, 'r') as in_f:
+            TranslateFile(writer, inputfile, in_f, stats)
+    else:
+        TranslateCommands(writer, inputfile, commands, stats)
+    return Fragment(writer, stats)
+
+
+def TranslateFragments(programs, options, workers=None):
+    # programs are [(inputfile, commands or None)]; the fragments come back
+    # in the same order whatever the number of workers
+    jobs = [(inputfile, commands, options) for inputfile, commands
+            in programs]
+    workers = workers or multiprocessing.cpu_count()
+    if len(jobs) <= 1 or workers == 1:
+        return [TranslateFragment(job) for job in jobs]
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        return pool.map(TranslateFragment, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def LinkFragments(writer, fragments, stats=None):
+    # appends the fragments to writer, moving their absolute addresses to
+    # where each fragment ends up
+    for fragment in fragments:
+        base = writer.line_count
+        lines = fragment.text.split('\n')
+        for index in fragment.relocations:
+            lines[index] = '@' + str(int(lines[index][1:]) + base)
+        writer.outputfile.write('\n'.join(lines))
+        writer.line_count += fragment.line_count
+        writer.return_count += fragment.return_count
+        writer.function_return_count += fragment.function_return_count
+        writer.linkage_size += fragment.linkage_size
+        for name in fragment.shared_routines:
+            writer.useSharedRoutine(name)
+        if stats != None:
+            for name, count in fragment.stats.items():
+                stats[name] = stats.get(name, 0) + count
+
+
+def SequenceSize(write):
+    # number of instructions a CodeWriter method call writes
+    writer = CodeWriter(io.StringIO())
+    writer.setFileName('Size.vm')
+    before = writer.line_count
+    write(writer)
+    return writer.line_count - before
+
+
+def PrintSizeReport(writer, routines_size):
+    size = writer.line_count
+    print('ROM size: %d instructions'%size)
+    if writer.shared_calls:
+        inline_size = (size - routines_size - writer.linkage_size
+                       + writer.return_count
+                         * SequenceSize(lambda w: w.writeCall('f', 0))
+                       + writer.function_return_count
+                         * SequenceSize(lambda w: w.writeReturn()))
+        print('Inline calls and returns: %d instructions (%d saved)'
+              %(inline_size, inline_size - size))
+
+
 def main():
-    if len(sys.argv) < 2:
-        print('Usage: %s filename/dirname'%sys.argv[0])
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    if not args:
+        print('Usage: %s [--optimize] [--inline[=N]] [--dce] [--tos] '
+              '[--shared-calls] [--compare=speed|size] [--jobs[=N]] '
+              'filename/dirname'%sys.argv[0])
         sys.exit(1)
-    inputpath = os.path.relpath(sys.argv[1])
+    compare_policy = 'speed'
+    inline_threshold = 0
+    jobs = [flag for flag in flags if flag.startswith('--jobs')]
+    workers = int(jobs[-1].split('=')[1]) if jobs and '=' in jobs[-1] else None
+    for flag in flags:
+        if flag.startswith('--compare='):
+            compare_policy = flag.split('=')[1]
+        elif flag == '--inline':
+            inline_threshold = VMoptimizer.INLINE_THRESHOLD
+        elif flag.startswith('--inline='):
+            inline_threshold = int(flag.split('=')[1])
+    inputpath = os.path.relpath(args[0])
     # get a list of VM files to be parsed
     inputfiles = ListVmFile(inputpath)
     
@@ -321,38 +932,62 @@ def main():
     else:
         outputfile = os.path.join(inputpath, os.path.split(inputpath)[1]+'.asm')
     out_f = open(outputfile, 'w')
-    writer = CodeWriter(out_f)
+    writer_class = TosCodeWriter if '--tos' in flags else CodeWriter
+    writer = writer_class(out_f, shared_calls='--shared-calls' in flags,
+                          compare_policy=compare_policy)
     has_sys_init = any(['Sys.vm' in inputfile for inputfile in inputfiles])
     if has_sys_init:
         writer.writeInit()
-    for inputfile in inputfiles:
-        in_f = open(inputfile, 'r')
-        parser = Parser(in_f)
-        writer.setFileName(inputfile)
-        while parser.hasMoreCommands():
-            writer.writeComments(parser.current_command)
-            ctype = parser.currentCommandType()
-            if ctype == CType.C_ARITHMETIC:
-                writer.writeArithmetic(parser.arg1())
-            elif ctype == CType.C_POP or ctype == CType.C_PUSH :
-                writer.writePushPop(ctype, parser.arg1(), parser.arg2())
-            elif ctype == CType.C_LABEL:
-                writer.writeLabel(parser.arg1())
-            elif ctype == CType.C_IF:
-                writer.writeIf(parser.arg1())
-            elif ctype == CType.C_GOTO:
-                writer.writeGoto(parser.arg1())
-            elif ctype == CType.C_FUNCTION:
-                writer.writeFunction(parser.arg1(), parser.arg2())
-            elif ctype == CType.C_CALL:
-                writer.writeCall(parser.arg1(), parser.arg2())
-            elif ctype == CType.C_RETURN:
-                writer.writeReturn()
-            else:
-                raise NotImplementedError('Command type not implemented!')  
-            parser.advance()
-        in_f.close()
+    stats = {} if '--optimize' in flags else None
+    programs = None
+    inlined = None
+    removed = None
+    if inline_threshold or '--dce' in flags:
+        # link-time mode: inline small functions across files and only
+        # translate functions reachable from the entry
+        programs = []
+        for inputfile in inputfiles:
+            with open(inputfile, 'r') as in_f:
+                programs.append((inputfile, ReadCommands(in_f)))
+        if inline_threshold:
+            programs, inlined = VMoptimizer.InlineFunctions(
+                programs, inline_threshold)
+        if '--dce' in flags:
+            programs, removed = VMoptimizer.RemoveDeadFunctions(
+                programs, VMoptimizer.EntryPoints(programs, has_sys_init))
+    if jobs:
+        # translate files independently, then link them in file order
+        if programs == None:
+            programs = [(inputfile, None) for inputfile in inputfiles]
+        options = (writer_class, writer.shared_calls, compare_policy,
+                   stats != None)
+        LinkFragments(writer, TranslateFragments(programs, options, workers),
+                      stats)
+    elif programs != None:
+        for inputfile, commands in programs:
+            TranslateCommands(writer, inputfile, commands, stats)
+    else:
+        for inputfile in inputfiles:
+            in_f = open(inputfile, 'r')
+            TranslateFile(writer, inputfile, in_f, stats)
+            in_f.close()
+    before_routines = writer.line_count
+    writer.writeSharedRoutines()
     writer.Close()
+    if writer.shared_calls:
+        PrintSizeReport(writer, writer.line_count - before_routines)
+    if stats != None:
+        VMoptimizer.PrintReport(stats, stats.get('before', 0),
+                                stats.get('after', 0))
+    if inlined != None:
+        print('Inlined %d calls to %d functions'%(sum(inlined.values()),
+                                                  len(inlined)))
+        for name in sorted(inlined):
+            print('  %s: %d'%(name, inlined[name]))
+    if removed != None:
+        print('Removed %d unreachable functions'%len(removed))
+        for name in removed:
+            print('  ' + name)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for VMoptimizer. Run with 'python3 -m unittest' from project8.
+"""
+import unittest
+
+import VMoptimizer
+
+
+class RemoveDeadStoresTest(unittest.TestCase):
+    def testKeepsTempLiveAcrossCall(self):
+        commands = [('function', 'A.f', 0),
+                    ('push', 'constant', 5), ('pop', 'temp', 1),
+                    ('call', 'B.g', 0), ('pop', 'temp', 0),
+                    ('push', 'temp', 1), ('return',)]
+        optimized, _ = VMoptimizer.Optimize(commands)
+        self.assertIn(('move', 'constant', 5, 'temp', 1), optimized)
+        self.assertIn(('pop', 'temp', 0), optimized)
+
+    def testDropsOverwrittenDoResult(self):
+        commands = [('function', 'A.f', 0),
+                    ('call', 'B.g', 0), ('pop', 'temp', 0),
+                    ('call', 'B.h', 0), ('pop', 'temp', 0),
+                    ('push', 'constant', 0), ('return',)]
+        optimized, hits = VMoptimizer.Optimize(commands)
+        self.assertEqual(hits['dead-store'], 1)
+        self.assertEqual(optimized[1:3], [('call', 'B.g', 0), ('discard',)])
+
+
+class InlineFunctionsTest(unittest.TestCase):
+    IDENTITY = [('function', 'A.id', 0), ('push', 'argument', 0),
+                ('return',)]
+
+    def testKeepsCallerTempLiveAcrossInlinedCall(self):
+        caller = [('function', 'A.f', 0),
+                  ('push', 'constant', 5), ('pop', 'temp', 1),
+                  ('push', 'constant', 3), ('call', 'A.id', 1),
+                  ('pop', 'temp', 0), ('push', 'temp', 1), ('return',)]
+        programs, inlined = VMoptimizer.InlineFunctions(
+            [('A.vm', caller + self.IDENTITY)])
+        self.assertEqual(inlined, {'A.id': 1})
+        commands, _ = VMoptimizer.Optimize(programs[0][1])
+        body = commands[:commands.index(('return',))]
+        self.assertIn(('move', 'constant', 5, 'temp', 1), body)
+        self.assertEqual([command for command in body
+                          if VMoptimizer.TempStored(command) == 1],
+                         [('move', 'constant', 5, 'temp', 1)])
+
+    def testKeepsTempLiveAcrossCallIntoInliningFunction(self):
+        # A.g inlines A.id; A.f keeps temp 1 live across its call to A.g
+        outer = [('function', 'A.f', 0),
+                 ('push', 'constant', 5), ('pop', 'temp', 1),
+                 ('call', 'A.g', 0), ('pop', 'temp', 0),
+                 ('push', 'temp', 1), ('return',)]
+        middle = [('function', 'A.g', 0), ('push', 'constant', 3),
+                  ('call', 'A.id', 1), ('return',)]
+        programs, inlined = VMoptimizer.InlineFunctions(
+            [('A.vm', outer + middle + self.IDENTITY)])
+        self.assertEqual(inlined, {'A.id': 1})
+        functions = dict(VMoptimizer.SplitFunctions(programs[0][1]))
+        self.assertEqual(VMoptimizer.SegmentIndices(functions['A.g'], 'temp')
+                         & {0, 1}, set())
+
+
+if __name__ == '__main__':
+    unittest.main()